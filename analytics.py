@@ -0,0 +1,164 @@
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+
+from reports import Reports
+from status import REPORT_FIELDS
+
+logger = logging.getLogger(__name__)
+
+
+class Analytics:
+    """Charge and driving analytics over the complete charge history.
+
+    The history is loaded into a DataFrame, one row per status snapshot, and every calculation
+    is made on whole columns rather than row by row.
+    """
+
+    def __init__(self, history):
+        self.history = history
+
+    @classmethod
+    def load(cls, vin=None):
+        """Load the charge history, reading the status snapshots as the charge report does.
+
+        The report fields are read directly rather than from the charge report, so the analytics
+        do not depend on the report sinks configured, or on the report being up to date.
+        """
+
+        history = pd.DataFrame.from_records(
+            ({fieldname: np.nan if details[fieldname] == "-" else details[fieldname] for fieldname in REPORT_FIELDS}
+             for details in Reports.status_details(vin)),
+            columns=REPORT_FIELDS
+        )
+        logging.info("Loaded %d status snapshots", len(history))
+        return cls(Analytics._prepare(history))
+
+    @staticmethod
+    def _prepare(history):
+        history["timestamp"] = pd.to_datetime(history["timestamp"], utc=True)
+        history = history.sort_values("timestamp", ignore_index=True)
+
+        # a charging session is a run of consecutive snapshots that are charging
+        charging = (history["charging_state"] == "charging").to_numpy()
+        starts = charging & ~np.concatenate(([False], charging[:-1]))
+        session = np.cumsum(starts).astype(float)
+        session[~charging] = np.nan
+        history["session"] = session
+
+        # energy delivered between each snapshot and the next (trapezium rule), belonging to the
+        # session of the earlier snapshot so that the last interval of each session is included
+        power = history["charge_power_kw"].fillna(0).to_numpy()
+        hours = history["timestamp"].diff().dt.total_seconds().to_numpy() / 3600
+        energy = np.zeros(len(history))
+        energy[:-1] = (power[1:] + power[:-1]) / 2 * hours[1:]
+        history["interval_energy_kwh"] = energy
+        history["interval_session"] = session
+
+        return history
+
+    def sessions(self):
+        """Return a row per charging session: energy delivered, average and peak power, SOC and range added."""
+
+        history = self.history
+        charging = history[history["session"].notna()]
+        grouped = charging.groupby("session")
+        sessions = pd.DataFrame({
+            "start_time": grouped["timestamp"].first(),
+            "charge_type": grouped["charge_type"].first(),
+            "start_soc_pct": grouped["current_soc_pct"].first(),
+            "start_range_km": grouped["cruising_range_electric_km"].first(),
+            "peak_power_kw": grouped["charge_power_kw"].max()
+        })
+
+        # the session ends with the first snapshot that is no longer charging
+        end_index = (charging.index.to_series().groupby(charging["session"]).max() + 1).clip(upper=len(history) - 1)
+        # indexed by session, so the columns keep their types when there are no sessions
+        ended = history.loc[end_index.to_numpy()].set_axis(end_index.index)
+        sessions["end_time"] = ended["timestamp"]
+        sessions["end_soc_pct"] = ended["current_soc_pct"]
+        sessions["end_range_km"] = ended["cruising_range_electric_km"]
+
+        sessions["energy_kwh"] = history.groupby("interval_session")["interval_energy_kwh"].sum()
+        sessions["duration_h"] = (sessions["end_time"] - sessions["start_time"]).dt.total_seconds() / 3600
+        sessions["average_power_kw"] = sessions["energy_kwh"] / sessions["duration_h"].replace(0, np.nan)
+        sessions["soc_added_pct"] = sessions["end_soc_pct"] - sessions["start_soc_pct"]
+        sessions["range_added_km"] = sessions["end_range_km"] - sessions["start_range_km"]
+        sessions["km_per_pct"] = sessions["range_added_km"] / sessions["soc_added_pct"].replace(0, np.nan)
+        return sessions.reset_index(drop=True)[[
+            "start_time", "end_time", "duration_h", "charge_type",
+            "energy_kwh", "average_power_kw", "peak_power_kw",
+            "start_soc_pct", "end_soc_pct", "soc_added_pct",
+            "start_range_km", "end_range_km", "range_added_km", "km_per_pct"
+        ]]
+
+    def charge_curve(self, soc_step=5):
+        """Return the mean charging power for each SOC band (of ``soc_step`` %), by charge type."""
+
+        charging = self.history[self.history["session"].notna()]
+        soc_band = (charging["current_soc_pct"] // soc_step * soc_step).rename("soc_pct")
+        return charging.pivot_table(
+            index=soc_band,
+            columns="charge_type",
+            values="charge_power_kw",
+            aggfunc="mean"
+        )
+
+    def monthly(self):
+        """Return monthly totals: sessions, energy and SOC added, distance driven and km per % of SOC used."""
+
+        history = self.history
+        month = history["timestamp"].dt.tz_localize(None).dt.to_period("M")
+
+        # SOC used while driving is the sum of the falls in SOC between snapshots
+        soc_change = history["current_soc_pct"].diff()
+        soc_used = (-soc_change).where(soc_change < 0, 0)
+
+        sessions = self.sessions()
+        session_month = sessions["start_time"].dt.tz_localize(None).dt.to_period("M")
+
+        monthly = pd.DataFrame({
+            "distance_km": history.groupby(month)["odometer"].max() - history.groupby(month)["odometer"].min(),
+            "soc_used_pct": soc_used.groupby(month).sum()
+        })
+        monthly["sessions"] = sessions.groupby(session_month).size()
+        monthly["energy_kwh"] = sessions.groupby(session_month)["energy_kwh"].sum()
+        monthly["soc_added_pct"] = sessions.groupby(session_month)["soc_added_pct"].sum()
+        monthly["km_per_pct"] = monthly["distance_km"] / monthly["soc_used_pct"].replace(0, np.nan)
+        monthly["sessions"] = monthly["sessions"].fillna(0).astype(int)
+        monthly.index.name = "month"
+        return monthly
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyse the charge history.")
+    parser.add_argument("--vin", help="analyse a single vehicle whose status is polled in fleet mode")
+    parser.add_argument("--sessions", action="store_true", help="show each charging session")
+    parser.add_argument("--curve", action="store_true", help="show charging power by SOC")
+    parser.add_argument("--monthly", action="store_true", help="show monthly totals")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        filename="log/reports.log",
+        level=logging.INFO,
+        format="%(asctime)s - %(message)s",
+        datefmt="%d-%b-%y %H:%M:%S",
+        force=True
+    )
+
+    logging.getLogger().addHandler(logging.StreamHandler())
+
+    show_all = not (args.sessions or args.curve or args.monthly)
+    analytics = Analytics.load(vin=args.vin)
+
+    pd.set_option("display.width", 200)
+    pd.set_option("display.max_columns", None)
+    pd.set_option("display.max_rows", None)
+    if args.sessions or show_all:
+        print(analytics.sessions().round(2).to_string(index=False), "\n")
+    if args.curve or show_all:
+        print(analytics.charge_curve().round(2).to_string(), "\n")
+    if args.monthly or show_all:
+        print(analytics.monthly().round(2).to_string(), "\n")
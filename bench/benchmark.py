@@ -0,0 +1,150 @@
+"""Benchmark the api calls and the charge report offline, against the mock server.
+
+Runs in a scratch directory holding its own config.ini (based on config.ini.template) and
+the synthetic status history:
+
+* login: a full web login
+* get_status: fetching and storing the status
+* set_charging: starting and stopping charging, each after a status check
+* charge report: a full run over the status history, and an incremental run with one new status
+
+    python bench/benchmark.py --years 2 --requests 50 --latency 0.05
+"""
+
+import argparse
+import configparser
+import datetime
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from generate_history import generate_history  # noqa: E402
+from mock_server import start_mock_server  # noqa: E402
+
+
+def write_config(server, vin):
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(os.path.join(ROOT_DIR, "config.ini.template"))
+    config["car"]["vin"] = vin
+    for name, url in server.config_urls().items():
+        config["url"][name] = url
+    config["reports"]["sinks"] = "csv"
+    config["http"]["retries"] = "0"
+    with open("config.ini", "w") as f:
+        config.write(f)
+
+
+def timed(function, repeat):
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+def latency_result(name, durations):
+    durations = sorted(durations)
+    return {
+        "name": name,
+        "count": len(durations),
+        "mean_ms": statistics.mean(durations) * 1000,
+        "p50_ms": durations[len(durations) // 2] * 1000,
+        "p95_ms": durations[min(len(durations) - 1, int(len(durations) * 0.95))] * 1000
+    }
+
+
+def run(args):
+    server = start_mock_server(latency=args.latency)
+    with open(os.path.join(BENCH_DIR, "responses", "vehicles.json")) as f:
+        vin = json.load(f)["data"][0]["vin"]
+    write_config(server, vin)
+    for directory in ("output", "reports", "log"):
+        os.makedirs(directory, exist_ok=True)
+
+    # imported once config.ini is in place
+    from car import Car
+    from reports import Reports
+    from tokens import Tokens
+    logging.basicConfig(filename="log/benchmark.log", level=logging.INFO, force=True)
+
+    results = []
+
+    # charge report, over the synthetic history only
+    status_file = "output/vehicle_status_%Y%m%d_%H%M%S.json"
+    start = datetime.datetime(2022, 6, 1)
+    end = start + datetime.timedelta(days=round(365.25 * args.years))
+    # the last status is held back for the incremental run, so the history carries on from where it left off
+    generated = generate_history(start, end + datetime.timedelta(minutes=15), status_file) - 1
+    last_filename = end.strftime(status_file)
+    os.replace(last_filename, "held_back_status.json")
+    started = time.perf_counter()
+    Reports.generate_charge_report(full=True)
+    duration = time.perf_counter() - started
+    results.append({"name": "charge report (full)", "files": generated, "s": duration,
+                    "files_per_s": generated / duration})
+
+    os.replace("held_back_status.json", last_filename)
+    started = time.perf_counter()
+    Reports.generate_charge_report()
+    results.append({"name": "charge report (incremental)", "files": 1, "s": time.perf_counter() - started})
+
+    # api calls
+    tokens = Tokens()
+    results.append(latency_result("login", timed(tokens.load_tokens_from_web, 1)))
+
+    car = Car(tokens=tokens)
+    results.append(latency_result("get_status", timed(car.get_status, args.requests)))
+
+    actions = ["start", "stop"] * args.requests
+    results.append(latency_result("set_charging", timed(lambda: car.set_charging(actions.pop()), args.requests)))
+
+    results.append({"name": "mock server requests", "count": server.requests})
+    server.shutdown()
+    return results
+
+
+def print_results(results):
+    for result in results:
+        if "mean_ms" in result:
+            print("{name:28} {count:6} x  mean {mean_ms:8.1f} ms  p50 {p50_ms:8.1f} ms  p95 {p95_ms:8.1f} ms".format(
+                **result))
+        elif "files_per_s" in result:
+            print("{name:28} {files:6} files  {s:8.2f} s  {files_per_s:10.0f} files/s".format(**result))
+        elif "files" in result:
+            print("{name:28} {files:6} files  {s:8.2f} s".format(**result))
+        else:
+            print("{name:28} {count:6}".format(**result))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the api calls and the charge report offline.")
+    parser.add_argument("--years", type=float, default=1, help="years of status history to report on")
+    parser.add_argument("--requests", type=int, default=20, help="api calls to time (default: 20)")
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to each mock server response")
+    parser.add_argument("--workdir", help="directory to run in (default: a new temporary directory)")
+    parser.add_argument("--results", help="append the results, as a line of json, to this file")
+    args = parser.parse_args()
+
+    results_file = os.path.abspath(args.results) if args.results else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="car-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    print("Running in " + workdir)
+
+    results = run(args)
+    print_results(results)
+    if results_file:
+        with open(results_file, "a") as f:
+            f.write(json.dumps({"timestamp": datetime.datetime.now().isoformat(), "args": vars(args),
+                                "results": results}) + "\n")
@@ -0,0 +1,135 @@
+"""Generate years of synthetic status files, for benchmarking the reports.
+
+The car is driven to work and back on weekdays, plugged in overnight whenever its SOC is
+low and charged from midnight up to its target SOC. Statuses taken before 2022-Dec are
+written in the pre 2022-Dec format (all groups under "data", values not wrapped in "value"),
+later ones in the current format, as the api returned them.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+
+# the api changed the format of the status data in December 2022
+CURRENT_FORMAT_FROM = datetime.datetime(2022, 12, 1)
+
+BATTERY_KWH = 58
+CHARGE_POWER_KW = 11
+KM_PER_PCT = 4
+
+
+def generate_history(start, end, status_file, interval=15, seed=1):
+    """Write a status file every ``interval`` minutes from start until end, returning the number written."""
+
+    rng = random.Random(seed)
+    step = datetime.timedelta(minutes=interval)
+    os.makedirs(os.path.dirname(start.strftime(status_file)) or ".", exist_ok=True)
+
+    soc = 80.0
+    odometer = 10000.0
+    plugged = False
+    count = 0
+    taken = start
+    while taken < end:
+        minute_of_day = taken.hour * 60 + taken.minute
+        weekday = taken.weekday() < 5
+        driving = weekday and (8 * 60 <= minute_of_day < 8 * 60 + 45 or 17 * 60 <= minute_of_day < 17 * 60 + 45)
+
+        if driving:
+            plugged = False
+            distance = rng.uniform(8, 14)
+            odometer += distance
+            soc = max(5.0, soc - distance / KM_PER_PCT)
+        elif minute_of_day == 19 * 60:
+            plugged = soc < 60 or rng.random() < 0.2
+        elif minute_of_day == 7 * 60 + 30:
+            plugged = False
+
+        charging = plugged and soc < 80 and minute_of_day < 7 * 60
+        if charging:
+            soc = min(80.0, soc + CHARGE_POWER_KW * interval / 60 / BATTERY_KWH * 100)
+
+        data = _status(taken, soc, odometer, plugged, charging)
+        with open(taken.strftime(status_file), "w") as f:
+            json.dump(data, f, sort_keys=True, indent=4)
+        count += 1
+        taken += step
+    return count
+
+
+def _status(taken, soc, odometer, plugged, charging):
+    timestamp = taken.strftime("%Y-%m-%dT%H:%M:%SZ")
+    remaining_minutes = round((80 - soc) / 100 * BATTERY_KWH / CHARGE_POWER_KW * 60)
+    charging_status = {
+        "carCapturedTimestamp": timestamp,
+        "chargeMode": "manual",
+        "chargePower_kW": CHARGE_POWER_KW if charging else 0,
+        "chargeRate_kmph": 60 if charging else 0,
+        "chargeType": "ac" if charging else "invalid",
+        "chargingState": "charging" if charging else ("readyForCharging" if plugged else "notReadyForCharging")
+    }
+    if charging:
+        charging_status["remainingChargingTimeToComplete_min"] = remaining_minutes
+    status = {
+        "charging": {
+            "batteryStatus": {"value": {
+                "carCapturedTimestamp": timestamp,
+                "cruisingRangeElectric_km": round(soc * KM_PER_PCT),
+                "currentSOC_pct": round(soc)
+            }},
+            "chargingSettings": {"value": {
+                "carCapturedTimestamp": timestamp,
+                "maxChargeCurrentAC": "maximum",
+                "targetSOC_pct": 80
+            }},
+            "chargingStatus": {"value": charging_status},
+            "plugStatus": {"value": {
+                "carCapturedTimestamp": timestamp,
+                "plugConnectionState": "connected" if plugged else "disconnected",
+                "plugLockState": "locked" if plugged else "unlocked"
+            }}
+        },
+        "climatisation": {
+            "climatisationStatus": {"value": {
+                "carCapturedTimestamp": timestamp,
+                "climatisationState": "off",
+                "remainingClimatisationTime_min": 0
+            }}
+        },
+        "fuelStatus": {
+            "rangeStatus": {"value": {
+                "carCapturedTimestamp": timestamp,
+                "totalRange_km": round(soc * KM_PER_PCT)
+            }}
+        },
+        "measurements": {
+            "odometerStatus": {"value": {
+                "carCapturedTimestamp": timestamp,
+                "odometer": round(odometer)
+            }}
+        }
+    }
+
+    if taken < CURRENT_FORMAT_FROM:
+        # every group directly under "data", without the "value" wrapper
+        status = {"data": {group: value["value"] for job in status.values() for group, value in job.items()}}
+    status["requestTimestamp"] = timestamp
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic status files.")
+    parser.add_argument("--years", type=float, default=1, help="years of statuses to generate")
+    parser.add_argument("--status-file", default="output/vehicle_status_%Y%m%d_%H%M%S.json",
+                        help="status filename format (default: %(default)s)")
+    parser.add_argument("--start", type=datetime.datetime.fromisoformat, default=datetime.datetime(2022, 6, 1),
+                        help="time of the first status (default: 2022-06-01, so both formats are generated)")
+    parser.add_argument("--interval", type=int, default=15, help="minutes between statuses (default: 15)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    end = args.start + datetime.timedelta(days=round(365.25 * args.years))
+    count = generate_history(args.start, end, args.status_file, args.interval, args.seed)
+    print("Generated {} status files".format(count))
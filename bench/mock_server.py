@@ -0,0 +1,211 @@
+"""A local stand-in for the vehicle api and the identity (login) service, for benchmarks.
+
+Recorded responses (see the responses directory) are replayed with fresh timestamps:
+
+* login: the login form, the password form (with the hmac within window._IDK), the redirect
+  to weconnect://authenticated and the access and refresh tokens
+* token refresh
+* /vehicles and /vehicles/<vin>/selectivestatus (only the requested jobs)
+* /vehicles/<vin>/charging/start|stop, which also change the charging state of the status
+
+The vehicle api rejects any access token it did not issue with a 401, as the real one does
+once a token expires. Use the urls printed on start up in the [url] section of config.ini.
+"""
+
+import argparse
+import base64
+import copy
+import datetime
+import json
+import os
+import re
+import secrets
+import threading
+import time
+import urllib.parse as urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RESPONSES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "responses")
+
+LOGIN_PATH = "/user-login/v1"
+API_PATH = "/vehicle/v1"
+
+
+class MockServer(ThreadingHTTPServer):
+    """Serves the recorded responses, adding ``latency`` seconds to each one."""
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0, token_lifetime=3600):
+        super().__init__(("127.0.0.1", port), MockRequestHandler)
+        self.latency = latency
+        self.token_lifetime = token_lifetime
+        self.lock = threading.Lock()
+        self.access_tokens = set()
+        self.refresh_tokens = set()
+        self.pending_tokens = None
+        self.charging_state = "readyForCharging"
+        self.requests = 0
+
+        with open(os.path.join(RESPONSES_DIR, "vehicles.json")) as f:
+            self.vehicles = json.load(f)
+        with open(os.path.join(RESPONSES_DIR, "selectivestatus.json")) as f:
+            self.status = json.load(f)
+        with open(os.path.join(RESPONSES_DIR, "charging.json")) as f:
+            self.charging = json.load(f)
+        with open(os.path.join(RESPONSES_DIR, "authorize.html")) as f:
+            self.authorize_page = f.read()
+        with open(os.path.join(RESPONSES_DIR, "identifier.html")) as f:
+            self.identifier_page = f.read()
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def config_urls(self):
+        """Return the [url] settings of config.ini for this server."""
+        return {"login": self.url + LOGIN_PATH, "identity": self.url, "api": self.url + API_PATH}
+
+    def issue_tokens(self):
+        expires = int(time.time()) + self.token_lifetime
+        claims = base64.urlsafe_b64encode(json.dumps({"exp": expires}).encode()).decode().rstrip("=")
+        tokens = {
+            "accessToken": "mock.{}.{}".format(claims, secrets.token_urlsafe(8)),
+            "refreshToken": secrets.token_urlsafe(16),
+            "idToken": secrets.token_urlsafe(16)
+        }
+        with self.lock:
+            self.access_tokens.add(tokens["accessToken"])
+            self.refresh_tokens.add(tokens["refreshToken"])
+        return tokens
+
+    def vehicle_status(self, jobs):
+        # the recorded status, captured now and holding only the requested jobs
+        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        status = {job: copy.deepcopy(value) for job, value in self.status.items() if job in jobs}
+        values = [status]
+        while values:
+            value = values.pop()
+            if isinstance(value, dict):
+                if "carCapturedTimestamp" in value:
+                    value["carCapturedTimestamp"] = timestamp
+                values.extend(value.values())
+        charging_status = status.get("charging", {}).get("chargingStatus", {}).get("value")
+        if charging_status is not None:
+            charging = self.charging_state == "charging"
+            charging_status["chargingState"] = self.charging_state
+            charging_status["chargePower_kW"] = 11 if charging else 0
+            charging_status["chargeRate_kmph"] = 60 if charging else 0
+            charging_status["chargeType"] = "ac" if charging else "invalid"
+        return status
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, method):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+
+        url = urlparse.urlsplit(self.path)
+        path = url.path
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+
+        # identity service
+        if method == "GET" and path == LOGIN_PATH + "/authorize":
+            return self._send(200, server.authorize_page, "text/html")
+        if method == "POST" and path.endswith("/login/identifier"):
+            return self._send(200, server.identifier_page, "text/html")
+        if method == "POST" and path.endswith("/login/authenticate"):
+            tokens = server.issue_tokens()
+            fragment = urlparse.urlencode({
+                "state": secrets.token_urlsafe(8),
+                "code": secrets.token_urlsafe(8),
+                "access_token": secrets.token_urlsafe(16),
+                "id_token": tokens["idToken"],
+                "token_type": "bearer"
+            })
+            server.pending_tokens = tokens
+            return self._redirect("weconnect://authenticated#" + fragment)
+        if method == "POST" and path == LOGIN_PATH + "/login/v1":
+            return self._send_json(200, server.pending_tokens or server.issue_tokens())
+        if method == "GET" and path == LOGIN_PATH + "/refresh/v1":
+            refresh_token = self.headers.get("Authorization", "")[len("Bearer "):]
+            if refresh_token not in server.refresh_tokens:
+                return self._send_json(401, {"error": "invalid refresh token"})
+            return self._send_json(200, server.issue_tokens())
+
+        # vehicle api
+        if not path.startswith(API_PATH):
+            return self._send_json(404, {"error": "not found"})
+        access_token = self.headers.get("Authorization", "")[len("Bearer "):]
+        if access_token not in server.access_tokens:
+            return self._send_json(401, {"error": "unauthorized"})
+
+        path = path[len(API_PATH):]
+        if method == "GET" and path == "/vehicles":
+            return self._send_json(200, server.vehicles)
+        if method == "GET" and re.fullmatch(r"/vehicles/[^/]+/selectivestatus", path):
+            jobs = urlparse.parse_qs(url.query).get("jobs", [""])[0].split(",")
+            return self._send_json(200, server.vehicle_status(jobs))
+        match = re.fullmatch(r"/vehicles/[^/]+/charging/(start|stop)", path)
+        if method == "POST" and match:
+            with server.lock:
+                server.charging_state = "charging" if match.group(1) == "start" else "readyForCharging"
+            return self._send_json(202, server.charging)
+        return self._send_json(404, {"error": "not found"})
+
+    def _send(self, code, body, content_type):
+        body = body.encode()
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, code, data):
+        self._send(code, json.dumps(data), "application/json")
+
+    def _redirect(self, location):
+        self.send_response(302)
+        self.send_header("Location", location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def start_mock_server(port=0, latency=0, token_lifetime=3600):
+    """Start a mock server on a background thread, returning the server."""
+    server = MockServer(port, latency, token_lifetime)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve recorded vehicle api and identity service responses.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to each response")
+    parser.add_argument("--token-lifetime", type=int, default=3600, help="seconds until each access token expires")
+    args = parser.parse_args()
+
+    server = MockServer(args.port, args.latency, args.token_lifetime)
+    print("[url]")
+    for name, url in server.config_urls().items():
+        print("{} = {}".format(name, url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
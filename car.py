@@ -1,39 +1,48 @@
-import configparser
 import datetime
-import requests
+import gzip
+import http_session
 import json
+import metrics
+import os
+import status
 import time
+import writer
+from config import config
 from tokens import Tokens
 import logging
 
 logger = logging.getLogger(__name__)
 
-config = configparser.ConfigParser()
-config.read("config.ini")
-
-user_agent = config.get("url", "user_agent")
-api_url = config.get("url", "api")
-
 
 class Car:
 
-    def __init__(self):
-        self.tokens = Tokens()
+    def __init__(self, vin=None, tokens=None):
+        """A vehicle on the account, by default the one configured in config.ini.
+
+        The status files of a vehicle chosen by vin are stored in its own sub directory.
+        Several Car instances may share the same tokens.
+        """
+        self.tokens = tokens or Tokens()
+        self.vin = vin or config.get("car", "vin")
+        self.status_file = config.get("settings", "vehicle_status_file")
+        self.status_cache_file = config.get("cache", "status_cache_file", fallback="output/status_cache.json")
+        if vin is not None:
+            self.status_file = status.vehicle_status_file(self.status_file, vin)
+            self.status_cache_file = status.vehicle_status_file(self.status_cache_file, vin)
 
     def get_vehicles(self):
         logging.info("Fetching vehicles")
         headers = {
-            "User-Agent": user_agent,
+            "User-Agent": config.get("url", "user_agent"),
             "Accept": "application/json",
             "Authorization": "Bearer {}".format(self.tokens.get_access_token())
         }
-        resp = self._get(api_url + "/vehicles", headers=headers)
+        resp = self._get(config.get("url", "api") + "/vehicles", headers=headers)
         resp_json = resp.json()
 
         # store vehicles in a file
         filename = time.strftime(config.get("settings", "vehicles_file"))
-        with open(filename, "w") as f:
-            json.dump(resp_json, f, sort_keys=True, indent=4)
+        writer.submit(filename, Car._write_vehicles, filename, resp_json)
 
         if resp_json["data"]:
             for d in resp_json["data"]:
@@ -42,67 +51,208 @@ class Car:
                 logging.info("    role     : %s", d["role"])
                 logging.info("    vin      : %s", d["vin"])
 
-    def get_status(self):
-        logging.info("Fetching vehicle status")
+        return resp_json
+
+    def get_status(self, max_age=0, profile="status"):
+        """Fetch, store and log the vehicle's status.
+
+        Only the jobs of the given profile (see the [jobs] section of config.ini) are requested. A
+        status fetched within the last ``max_age`` seconds, covering at least those jobs, is
+        returned instead of fetching it again. Only statuses of the profiles listed in the [jobs]
+        store setting (by default only status) are stored, the others (e.g. the charging check)
+        only update the status cache.
+        """
+        jobs = config.get("jobs", profile, fallback=config.get("api", "jobs"))
+        status_cache = self._load_status_cache()
+        if max_age \
+                and status_cache is not None \
+                and "status" in status_cache \
+                and time.time() - status_cache["fetched_at"] <= max_age \
+                and set(jobs.split(",")) <= set(status_cache.get("jobs", "").split(",")):
+            logging.info("Using vehicle status fetched at %s (vin: %s)",
+                         status_cache["status"]["requestTimestamp"], self.vin)
+            return status_cache["status"]
+
+        logging.info("Fetching vehicle status (vin: %s)", self.vin)
         headers = {
-            "User-Agent": user_agent,
+            "User-Agent": config.get("url", "user_agent"),
             "Accept": "application/json",
             "Authorization": "Bearer {}".format(self.tokens.get_access_token())
         }
-        vin = config.get("car", "vin")
-        jobs = config.get("api", "jobs")
-        resp = self._get(f"{api_url}/vehicles/{vin}/selectivestatus?jobs={jobs}", headers=headers)
+        resp = self._get(f"{config.get('url', 'api')}/vehicles/{self.vin}/selectivestatus?jobs={jobs}", headers=headers)
         resp_json = resp.json()
 
         resp_json["requestTimestamp"] = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
 
-        # store status in a file
-        filename = time.strftime(config.get("settings", "vehicle_status_file"))
-        with open(filename, "w") as f:
-            json.dump(resp_json, f, sort_keys=True, indent=4)
+        # the status is unchanged if the car has not captured anything new since the last stored status
+        fetched_at = time.time()
+        captured_timestamps = status.captured_timestamps(resp_json)
+        unchanged_status = config.get("cache", "unchanged_status", fallback="store")
+        unchanged = unchanged_status != "store" \
+            and status_cache is not None \
+            and status_cache.get("jobs") == jobs \
+            and status_cache["captured_timestamps"] == captured_timestamps \
+            and status_cache["stored_at"] is not None \
+            and fetched_at - status_cache["stored_at"] < config.getint("cache", "unchanged_ttl", fallback=3600)
 
-        if resp_json["charging"]:
-            plug_connection_state = resp_json["charging"]["plugStatus"]["value"]["plugConnectionState"]
-            charging_state = resp_json["charging"]["chargingStatus"]["value"]["chargingState"]
-            current_soc = resp_json["charging"]["batteryStatus"]["value"]["currentSOC_pct"]
-            battery_status_timestamp = resp_json["charging"]["batteryStatus"]["value"]["carCapturedTimestamp"]
-            odometer = resp_json["measurements"]["odometerStatus"]["value"]["odometer"]
-            total_range = resp_json["fuelStatus"]["rangeStatus"]["value"]["totalRange_km"]
+        stored_profiles = config.get("jobs", "store", fallback="status").split(",")
+        if profile not in [stored_profile.strip() for stored_profile in stored_profiles]:
+            # a partial status (e.g. the charging check) would leave gaps in the reports
+            stored_at = status_cache["stored_at"] if status_cache is not None else None
+            stored_timestamp = status_cache["stored_timestamp"] if status_cache is not None else None
+        elif not unchanged:
+            self._store_status(resp_json, resp.content)
+            stored_at = fetched_at
+            stored_timestamp = resp_json["requestTimestamp"]
+        else:
+            stored_at = status_cache["stored_at"]
+            stored_timestamp = status_cache["stored_timestamp"]
+            if unchanged_status == "marker":
+                logging.info("Vehicle status unchanged since %s, storing marker", stored_timestamp)
+                self._store_status(status.unchanged_marker(resp_json["requestTimestamp"], stored_timestamp))
+            else:
+                logging.info("Vehicle status unchanged since %s, not storing", stored_timestamp)
 
-            remaining_mins = resp_json.get("charging", {}).\
-                get("chargingStatus", {}).\
-                get("value", {}).\
-                get("remainingChargingTimeToComplete_min", None)
+        status_cache = {
+            "jobs": jobs,
+            "fetched_at": fetched_at,
+            "stored_at": stored_at,
+            "stored_timestamp": stored_timestamp,
+            "captured_timestamps": captured_timestamps
+        }
+        if config.getint("cache", "status_max_age", fallback=0) > 0:
+            # the status itself is only needed when it may be reused by the charging commands
+            status_cache["status"] = resp_json
+        self._save_status_cache(status_cache)
+
+        if resp_json.get("charging"):
+            # odometer and range are only available when the measurements and fuelStatus jobs are requested
+            summary = status.get_values(resp_json, [
+                "plug_connection_state", "charging_state", "charge_mode", "charge_power_kw", "charge_type",
+                "remaining_charging_time_m", "current_soc_pct", "battery_status_timestamp", "odometer",
+                "total_range_km"
+            ])
 
             time_left = "??? remaining"
-            if remaining_mins is not None:
-                r_hour, r_min = divmod(remaining_mins, 60)
+            if summary["remaining_charging_time_m"] is not None:
+                r_hour, r_min = divmod(summary["remaining_charging_time_m"], 60)
                 time_left = "{}h {}m remaining".format(r_hour, r_min)
 
             charging_info = "{}, {} kW {}, {}".format(
-                resp_json["charging"]["chargingStatus"]["value"]["chargeMode"],
-                resp_json["charging"]["chargingStatus"]["value"]["chargePower_kW"],
-                resp_json["charging"]["chargingStatus"]["value"]["chargeType"],
+                summary["charge_mode"],
+                summary["charge_power_kw"],
+                summary["charge_type"],
                 time_left
             )
-            logging.info("plug_connection_state    : %s", plug_connection_state)
-            logging.info("charging_state           : {} ({})".format(charging_state, charging_info))
-            logging.info("current_soc              : %s%%", current_soc)
-            logging.info("battery_status_timestamp : %s", battery_status_timestamp)
-            logging.info("odometer                 : {:,} (range {:,})".format(odometer, total_range))
+            logging.info("plug_connection_state    : %s", summary["plug_connection_state"])
+            logging.info("charging_state           : {} ({})".format(summary["charging_state"], charging_info))
+            logging.info("current_soc              : %s%%", summary["current_soc_pct"])
+            logging.info("battery_status_timestamp : %s", summary["battery_status_timestamp"])
+            if summary["odometer"] is not None and summary["total_range_km"] is not None:
+                logging.info("odometer                 : {:,} (range {:,})".format(
+                    summary["odometer"], summary["total_range_km"]))
 
         return resp_json
 
+    @staticmethod
+    def _write_vehicles(filename, data):
+        with metrics.timer("file_write_duration_seconds", file="vehicles"):
+            with open(filename, "w") as f:
+                json.dump(data, f, sort_keys=True, indent=4)
+
+    def _store_status(self, data, content=None):
+        """Store the status in a file and/or the history store, in the background (see writer.py).
+
+        The status file is written in the status_format set in config.ini: pretty printed json,
+        or the raw json of the response (the content) as received, optionally compressed.
+        """
+        # named after the time the status was fetched, not when it is written
+        filename = time.strftime(self.status_file)
+        writer.submit(filename, self._write_status, filename, data, content)
+
+    def _write_status(self, filename, data, content):
+        status_store = config.get("settings", "status_store", fallback="file")
+        if status_store in ("file", "both"):
+            os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+            status_format = config.get("settings", "status_format", fallback="pretty")
+            with metrics.timer("file_write_duration_seconds", file="status"):
+                if status_format == "pretty":
+                    with open(filename, "w") as f:
+                        json.dump(data, f, sort_keys=True, indent=4)
+                else:
+                    status_filename, content = Car._encode_status(filename, data, content, status_format)
+                    with open(status_filename, "wb") as f:
+                        f.write(content)
+        if status_store in ("history", "both"):
+            # only imported when used, to keep the startup of the status command fast
+            from history import History
+            with metrics.timer("file_write_duration_seconds", file="history"):
+                history = History()
+                history.append(filename, self.vin, data)
+                history.close()
+
+    @staticmethod
+    def _encode_status(filename, data, content, status_format):
+        # the raw json of the response, with the requestTimestamp added, avoids encoding the status again
+        content = Car._with_request_timestamp(content, data["requestTimestamp"]) if content is not None else None
+        if content is None:
+            content = json.dumps(data).encode()
+
+        if status_format == "zstd":
+            try:
+                import zstandard
+                return filename + status.COMPRESSION_SUFFIXES["zstd"], zstandard.ZstdCompressor().compress(content)
+            except ImportError:
+                logging.warning("zstandard is not installed, storing the status using gzip instead")
+                status_format = "gzip"
+        if status_format == "gzip":
+            return filename + status.COMPRESSION_SUFFIXES["gzip"], gzip.compress(content, compresslevel=6)
+        return filename, content
+
+    @staticmethod
+    def _with_request_timestamp(content, request_timestamp):
+        # add the requestTimestamp as the first member of the json object, or None if the content is not an object
+        body = content.lstrip()
+        if not body.startswith(b"{"):
+            return None
+        members = body[1:].lstrip()
+        separator = b"" if members.startswith(b"}") else b", "
+        return b'{"requestTimestamp": ' + json.dumps(request_timestamp).encode() + separator + members
+
+    def _load_status_cache(self):
+        # a status cache still being saved by an earlier call must be read as saved
+        writer.wait(self.status_cache_file)
+        if not os.path.isfile(self.status_cache_file):
+            return None
+        with open(self.status_cache_file, "r") as f:
+            return json.load(f)
+
+    def _save_status_cache(self, status_cache):
+        writer.submit(self.status_cache_file, self._write_status_cache, status_cache)
+
+    def _write_status_cache(self, status_cache):
+        with metrics.timer("file_write_duration_seconds", file="status_cache"):
+            with writer.atomic_open(self.status_cache_file) as f:
+                json.dump(status_cache, f)
+
     # action = start | stop
-    def set_charging(self, action="start"):
-        resp_json = self.get_status()
+    def set_charging(self, action="start", resp_json=None):
+        """Request the vehicle to start or stop charging, returning the requestID.
+
+        The charging state is checked using the status data if given (e.g. that of a status just
+        fetched), otherwise a status is fetched first. None is returned if no request was sent,
+        e.g. the car is already charging.
+        """
+        if resp_json is None:
+            resp_json = self.get_status(max_age=config.getint("cache", "status_max_age", fallback=0),
+                                        profile="charging")
 
-        if not resp_json["charging"]:
+        if not resp_json.get("charging"):
             logging.error("Unable to determine current connection and charging status")
             return
 
-        plug_connection_state = resp_json["charging"]["plugStatus"]["value"]["plugConnectionState"]
-        charging_state = resp_json["charging"]["chargingStatus"]["value"]["chargingState"]
+        plug_connection_state = status.get_value(resp_json, "plug_connection_state")
+        charging_state = status.get_value(resp_json, "charging_state")
 
         if not plug_connection_state == "connected":
             logging.warn("Plug needs to be connected - currently: %s", plug_connection_state)
@@ -117,25 +267,25 @@ class Car:
         logging.info("Requesting vehicle to %s charging", action)
 
         headers = {
-            "User-Agent": user_agent,
+            "User-Agent": config.get("url", "user_agent"),
             "Content-type": "application/json",
             "Content-version": "1",
             "Accept": "*/*",
             "Authorization": "Bearer {}".format(self.tokens.get_access_token())
         }
-        vin = config.get("car", "vin")
-        resp = self._post(api_url + "/vehicles/" + vin + "/charging/" + action, headers=headers)
+        resp = self._post(config.get("url", "api") + "/vehicles/" + self.vin + "/charging/" + action, headers=headers)
         resp_json = resp.json()
         logging.info("requestID: %s", resp_json["data"]["requestID"])
+        return resp_json["data"]["requestID"]
 
     def _post(self, url, headers):
         retry_attempts = 1
         while retry_attempts >= 0:
             retry_attempts -= 1
-            resp = requests.post(url, headers=headers)
+            resp = http_session.get_session().post(url, headers=headers)
             if resp.status_code == 401:
                 logging.warning("401 Unauthorized (access token has probably expired)")
-                self.tokens.refresh_tokens_from_web()
+                self.tokens.refresh_tokens_from_web(headers["Authorization"][len("Bearer "):])
                 headers["Authorization"] = "Bearer {}".format(self.tokens.get_access_token())
             else:
                 break
@@ -146,10 +296,10 @@ class Car:
         retry_attempts = 1
         while retry_attempts >= 0:
             retry_attempts -= 1
-            resp = requests.get(url, headers=headers)
+            resp = http_session.get_session().get(url, headers=headers)
             if resp.status_code == 401:
                 logging.warning("401 Unauthorized (access token has probably expired)")
-                self.tokens.refresh_tokens_from_web()
+                self.tokens.refresh_tokens_from_web(headers["Authorization"][len("Bearer "):])
                 headers["Authorization"] = "Bearer {}".format(self.tokens.get_access_token())
             else:
                 break
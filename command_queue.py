@@ -0,0 +1,133 @@
+import datetime
+import fcntl
+import json
+import logging
+import os
+import status
+import time
+import writer
+from config import config
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class CommandQueue:
+    """The charging command (start or stop) waiting to be sent to, or confirmed by, each vehicle.
+
+    The queue is held in a file that is locked while it is in use, so commands from overlapping
+    runs (e.g. cron jobs and the daemon) are never sent at the same time. Queuing the command
+    that is already queued does nothing more, so repeating a command does not send it again.
+    Once sent, a command is kept until a status shows the car's charging state has changed. If
+    that has not happened within confirm_timeout seconds it is sent again, waiting twice as long
+    for each attempt, up to max_attempts times.
+    """
+
+    def __init__(self, car):
+        self.car = car
+        self.queue_file = config.get("queue", "queue_file", fallback="output/command_queue.json")
+        self.confirm_timeout = config.getint("queue", "confirm_timeout", fallback=600)
+        self.max_attempts = config.getint("queue", "max_attempts", fallback=3)
+
+    def submit(self, action, resp_json=None):
+        """Queue the charging action (start | stop) and send it, unless it is already queued.
+
+        The status data, if given, is used to check the charging state instead of fetching a status.
+        """
+        with self._commands() as commands:
+            command = commands.get(self.car.vin)
+            if command is not None and command["action"] == action:
+                logging.info("Request to %s charging is already queued (requestID: %s)",
+                             action, command["request_id"])
+            else:
+                if command is not None:
+                    logging.info("Replacing queued request to %s charging", command["action"])
+                commands[self.car.vin] = {
+                    "action": action,
+                    "queued_at": time.time(),
+                    "attempts": 0,
+                    "request_id": None,
+                    "sent_timestamp": None,
+                    "next_attempt_at": 0
+                }
+            self._process(commands, resp_json)
+
+    def process(self, resp_json=None):
+        """Confirm, or send again, the queued charging action, using the status data if given."""
+        with self._commands() as commands:
+            self._process(commands, resp_json)
+
+    def pending(self):
+        """Return whether a charging action is waiting to be sent or confirmed."""
+        with self._commands() as commands:
+            return self.car.vin in commands
+
+    def _process(self, commands, resp_json=None):
+        command = commands.get(self.car.vin)
+        if command is None:
+            return
+
+        if command["request_id"] is not None:
+            if resp_json is None:
+                resp_json = self.car.get_status(profile="charging")
+            if self._confirmed(command, resp_json):
+                logging.info("Request to %s charging confirmed (requestID: %s)",
+                             command["action"], command["request_id"])
+                del commands[self.car.vin]
+                return
+            if time.time() < command["next_attempt_at"]:
+                logging.info("Waiting for the request to %s charging to be confirmed (requestID: %s)",
+                             command["action"], command["request_id"])
+                return
+        elif time.time() < command["next_attempt_at"]:
+            return
+
+        # also limits the attempts of a request that failed to send (e.g. an http error)
+        if command["attempts"] >= self.max_attempts:
+            logging.error("Request to %s charging not confirmed after %d attempts, giving up",
+                          command["action"], command["attempts"])
+            del commands[self.car.vin]
+            return
+        if command["request_id"] is not None:
+            logging.warning("Request to %s charging not confirmed (requestID: %s), sending it again",
+                            command["action"], command["request_id"])
+
+        # counted before sending, so a request that fails is not retried until the backoff has passed
+        command["attempts"] += 1
+        command["next_attempt_at"] = time.time() + self.confirm_timeout * 2 ** (command["attempts"] - 1)
+        sent_timestamp = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        request_id = self.car.set_charging(command["action"], resp_json)
+        if request_id is None:
+            # nothing to do (or nothing that can be done, e.g. unplugged)
+            del commands[self.car.vin]
+            return
+        command["request_id"] = request_id
+        command["sent_timestamp"] = sent_timestamp
+
+    @staticmethod
+    def _confirmed(command, resp_json):
+        # only a charging status captured after the request was sent can confirm it
+        captured = status.get_value(resp_json, "car_captured_timestamp", None)
+        if captured is None or str(captured) < command["sent_timestamp"]:
+            return False
+        charging = status.get_value(resp_json, "charging_state", None) == "charging"
+        return charging if command["action"] == "start" else not charging
+
+    @contextmanager
+    def _commands(self):
+        # the queued commands by vin, saved on leaving the with statement; the lock is held until then
+        os.makedirs(os.path.dirname(self.queue_file) or ".", exist_ok=True)
+        with open(self.queue_file + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                commands = {}
+                if os.path.isfile(self.queue_file):
+                    with open(self.queue_file, "r") as f:
+                        commands = json.load(f)
+                try:
+                    yield commands
+                finally:
+                    with writer.atomic_open(self.queue_file) as f:
+                        json.dump(commands, f, indent=4)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,27 @@
+"""The settings in config.ini, shared by every module.
+
+The file is only read when a setting is first looked up rather than when a module is
+imported, so commands that never use a setting do not pay for parsing it.
+"""
+
+import configparser
+
+CONFIG_FILE = "config.ini"
+
+
+class _LazyConfig:
+    """A ConfigParser that reads its file on first use."""
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._parser = None
+
+    def __getattr__(self, name):
+        if self._parser is None:
+            parser = configparser.ConfigParser()
+            parser.read(self._filename)
+            self._parser = parser
+        return getattr(self._parser, name)
+
+
+config = _LazyConfig(CONFIG_FILE)
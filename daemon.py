@@ -0,0 +1,101 @@
+import datetime
+import logging
+import metrics
+import sched
+import status
+import time
+import writer
+from command_queue import CommandQueue
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+class Daemon:
+    """Keep a single Car alive, polling its status and sending charging commands on a schedule.
+
+    The status is polled often while the car is charging and rarely while it is unplugged.
+    """
+
+    def __init__(self, car):
+        self.car = car
+        self.command_queue = CommandQueue(car)
+        self.scheduler = sched.scheduler(time.time, time.sleep)
+        self.next_poll = None
+        self.poll_intervals = {
+            "charging": config.getint("daemon", "poll_interval_charging", fallback=300),
+            "plugged": config.getint("daemon", "poll_interval_plugged", fallback=900),
+            "unplugged": config.getint("daemon", "poll_interval_unplugged", fallback=3600)
+        }
+        self.charging_times = {
+            "start": Daemon._parse_times(config.get("daemon", "start_charging", fallback="")),
+            "stop": Daemon._parse_times(config.get("daemon", "stop_charging", fallback=""))
+        }
+
+    def run(self):
+        logging.info("Starting daemon (poll intervals: %s)", self.poll_intervals)
+        self._schedule_poll(0)
+        for action, times_of_day in self.charging_times.items():
+            for time_of_day in times_of_day:
+                self._schedule_charging(action, time_of_day)
+        try:
+            self.scheduler.run()
+        except KeyboardInterrupt:
+            logging.info("Stopping daemon")
+
+    def poll(self):
+        interval = self.poll_intervals["plugged"]
+        try:
+            resp_json = self.car.get_status()
+            interval = self._poll_interval(resp_json)
+            self.command_queue.process(resp_json)
+            if self.command_queue.pending():
+                interval = min(interval, self.poll_intervals["charging"])
+            writer.wait()
+        except Exception as e:
+            logging.exception("Exception polling status: " + str(e))
+        metrics.export()
+        self._schedule_poll(interval)
+
+    def charge(self, action, time_of_day):
+        try:
+            self.command_queue.submit(action)
+            writer.wait()
+        except Exception as e:
+            logging.exception("Exception requesting vehicle to {} charging: {}".format(action, str(e)))
+        metrics.export()
+        self._schedule_charging(action, time_of_day)
+
+        # keep a close eye on the car until the next poll shows whether the command took effect
+        self._schedule_poll(min(self._seconds_until_next_poll(), self.poll_intervals["charging"]))
+
+    def _poll_interval(self, resp_json):
+        if status.get_value(resp_json, "charging_state", None) == "charging":
+            return self.poll_intervals["charging"]
+        if status.get_value(resp_json, "plug_connection_state", None) == "connected":
+            return self.poll_intervals["plugged"]
+        return self.poll_intervals["unplugged"]
+
+    def _schedule_poll(self, delay):
+        if self.next_poll is not None and self.next_poll in self.scheduler.queue:
+            self.scheduler.cancel(self.next_poll)
+        logging.info("Next status poll in %d seconds", delay)
+        self.next_poll = self.scheduler.enter(delay, 1, self.poll)
+
+    def _seconds_until_next_poll(self):
+        if self.next_poll is None or self.next_poll not in self.scheduler.queue:
+            return 0
+        return max(0, self.next_poll.time - time.time())
+
+    def _schedule_charging(self, action, time_of_day):
+        now = datetime.datetime.now()
+        when = datetime.datetime.combine(now.date(), time_of_day)
+        if when <= now:
+            when += datetime.timedelta(days=1)
+        logging.info("Next %s charging command at %s", action, when)
+        self.scheduler.enterabs(when.timestamp(), 0, self.charge, (action, time_of_day))
+
+    @staticmethod
+    def _parse_times(value):
+        """Parse a comma separated list of HH:MM times of day."""
+        return [datetime.datetime.strptime(t.strip(), "%H:%M").time() for t in value.split(",") if t.strip()]
@@ -0,0 +1,47 @@
+import asyncio
+import logging
+from car import Car
+from config import config
+from tokens import Tokens
+
+logger = logging.getLogger(__name__)
+
+
+class Fleet:
+    """All the vehicles on the account, whose status is fetched concurrently using a shared set of tokens."""
+
+    def __init__(self, tokens=None):
+        self.tokens = tokens or Tokens()
+        self.concurrency = config.getint("fleet", "concurrency", fallback=4)
+
+    def get_vins(self):
+        """Return the vins listed in config.ini, or failing that every vin on the account."""
+        vins = [vin.strip() for vin in config.get("fleet", "vins", fallback="").split(",") if vin.strip()]
+        if not vins:
+            resp_json = Car(tokens=self.tokens).get_vehicles()
+            vins = [d["vin"] for d in resp_json["data"] or []]
+        return vins
+
+    def get_status(self):
+        """Fetch (and store) the status of every vehicle, returning the status data by vin."""
+        return asyncio.run(self._get_statuses(self.get_vins()))
+
+    async def _get_statuses(self, vins):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(
+            *(self._get_status(semaphore, vin) for vin in vins),
+            return_exceptions=True
+        )
+
+        statuses = {}
+        for vin, result in zip(vins, results):
+            if isinstance(result, Exception):
+                logging.error("Unable to fetch status (vin: %s): %s", vin, result)
+            else:
+                statuses[vin] = result
+        return statuses
+
+    async def _get_status(self, semaphore, vin):
+        async with semaphore:
+            # requests is blocking, so each status fetch runs in its own worker thread
+            return await asyncio.to_thread(Car(vin, tokens=self.tokens).get_status)
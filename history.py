@@ -0,0 +1,222 @@
+import argparse
+import bisect
+import glob
+import json
+import logging
+import os
+import sqlite3
+import status
+import zlib
+
+from config import config
+from status import REPORT_FIELDS, UNCHANGED_MARKER, extract_details, status_filename_pattern
+
+logger = logging.getLogger(__name__)
+
+
+class History:
+    """Append-only store of vehicle status snapshots held in a local SQLite database.
+
+    Each snapshot is stored as a single row, keyed by the name of the status file it
+    replaces, holding the report fields in their own columns alongside the complete
+    (zlib compressed) status payload.
+    """
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = config.get("settings", "history_file", fallback="output/history.db")
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self._create_table()
+
+    def _create_table(self):
+        # report columns are declared without a type so that values are returned exactly as stored
+        columns = ", ".join('"{}"'.format(fieldname) for fieldname in REPORT_FIELDS)
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS status (filename TEXT PRIMARY KEY, vin TEXT, {columns}, payload BLOB)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS status_timestamp ON status (timestamp)")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def append(self, filename, vin, data):
+        """Store a status snapshot."""
+        self._insert(filename, vin, data)
+        self.connection.commit()
+
+    def _insert(self, filename, vin, data):
+        details = extract_details(data)
+        if UNCHANGED_MARKER in data:
+            # an unchanged status takes its report fields from the status it is unchanged since
+            columns = ", ".join('"{}"'.format(fieldname) for fieldname in REPORT_FIELDS)
+            row = self.connection.execute(
+                f"SELECT {columns} FROM status WHERE vin = ? AND timestamp = ?",
+                [vin, data[UNCHANGED_MARKER]]
+            ).fetchone()
+            if row is not None:
+                details = dict(zip(REPORT_FIELDS, row), timestamp=data["requestTimestamp"])
+        payload = zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+        placeholders = ", ".join("?" for _ in range(len(REPORT_FIELDS) + 3))
+        self.connection.execute(
+            f"INSERT OR REPLACE INTO status VALUES ({placeholders})",
+            [filename, vin] + [details[fieldname] for fieldname in REPORT_FIELDS] + [payload]
+        )
+
+    def details(self, filename_pattern="*", after=None):
+        """Yield (filename, report fields) in time order for each snapshot matching the glob pattern after ``after``."""
+        columns = ", ".join('"{}"'.format(fieldname) for fieldname in REPORT_FIELDS)
+        cursor = self.connection.execute(
+            f"SELECT filename, {columns} FROM status WHERE filename GLOB ? AND filename > ? ORDER BY filename",
+            [filename_pattern, after or ""]
+        )
+        for row in cursor:
+            yield row[0], dict(zip(REPORT_FIELDS, row[1:]))
+
+    def sizes(self, filename_pattern="*"):
+        """Yield (filename, payload size) in time order for each snapshot matching the glob pattern."""
+        yield from self.connection.execute(
+            "SELECT filename, length(payload) FROM status WHERE filename GLOB ? ORDER BY filename",
+            [filename_pattern]
+        )
+
+    def query(self, filename_pattern, first_filename, last_filename, fieldnames):
+        """Yield the requested fields of each snapshot matching the glob pattern, from first to last filename.
+
+        Report fields are read from their own columns, only other fields are decoded from the payload.
+        """
+        columns = [fieldname for fieldname in fieldnames if fieldname in REPORT_FIELDS]
+        decode = len(columns) < len(fieldnames)
+        selected = ", ".join(["vin"] + ['"{}"'.format(column) for column in columns] + (["payload"] if decode else []))
+        cursor = self.connection.execute(
+            f"SELECT {selected} FROM status WHERE filename GLOB ? AND filename BETWEEN ? AND ? ORDER BY filename",
+            [filename_pattern, first_filename, last_filename]
+        )
+        for row in cursor:
+            values = dict(zip(columns, row[1:]))
+            if decode:
+                data = json.loads(zlib.decompress(row[-1]))
+                if UNCHANGED_MARKER in data:
+                    data = self._unchanged_since(row[0], data)
+                for fieldname in fieldnames:
+                    if fieldname not in values:
+                        values[fieldname] = status.get_value(data, fieldname, "-")
+            yield {fieldname: values[fieldname] for fieldname in fieldnames}
+
+    def _unchanged_since(self, vin, marker):
+        # the status an unchanged status marker refers to, with the marker's timestamp
+        row = self.connection.execute(
+            "SELECT payload FROM status WHERE vin = ? AND timestamp = ?",
+            [vin, marker[UNCHANGED_MARKER]]
+        ).fetchone()
+        if row is None:
+            return marker
+        return dict(json.loads(zlib.decompress(row[0])), requestTimestamp=marker["requestTimestamp"])
+
+    def load(self, filename):
+        """Return the complete status data for a snapshot, or None if it is not stored."""
+        row = self.connection.execute("SELECT payload FROM status WHERE filename = ?", [filename]).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def import_files(self, filename_pattern, vin):
+        """Import status files that are not already stored, returning the number imported."""
+        stored = set(row[0] for row in self.connection.execute("SELECT filename FROM status"))
+
+        imported = 0
+        for filename in sorted(glob.glob(filename_pattern)):
+            # stored under the name of the uncompressed status file, as when the status was fetched
+            key = status.uncompressed_filename(filename)
+            if key in stored:
+                continue
+            stored.add(key)
+            self._insert(key, vin, status.load_status(filename))
+            imported += 1
+            if imported % 1000 == 0:
+                logging.info("Imported %d status files", imported)
+                self.connection.commit()
+
+        self.connection.commit()
+        return imported
+
+
+def query_history(start, end, fieldnames, vin=None):
+    """Yield the requested fields of each status snapshot taken between the start and end (local) times.
+
+    The status filenames (or history store keys) are named after the time each status was taken,
+    so they serve as an index: only the snapshots within the time range are read.
+    """
+    status_file = config.get("settings", "vehicle_status_file")
+    if vin is not None:
+        status_file = status.vehicle_status_file(status_file, vin)
+    filename_pattern = status_filename_pattern(status_file)
+    first_filename = start.strftime(status_file)
+    # also take in a (compressed) status file with a suffix after the .json of the last filename
+    last_filename = end.strftime(status_file) + "\uffff"
+
+    if config.get("settings", "status_store", fallback="file") in ("history", "both"):
+        history = History()
+        try:
+            yield from history.query(filename_pattern, first_filename, last_filename, fieldnames)
+        finally:
+            history.close()
+        return
+
+    filenames = sorted(glob.glob(filename_pattern))
+    first = bisect.bisect_left(filenames, first_filename)
+    last = bisect.bisect_right(filenames, last_filename)
+
+    previous = None
+    for index in range(first, last):
+        data = status.load_status(filenames[index])
+        if UNCHANGED_MARKER in data:
+            # the car had not reported anything new, so use the latest full status
+            if previous is None:
+                previous = _previous_status(filenames, index)
+            if previous is not None:
+                data = dict(previous, requestTimestamp=data["requestTimestamp"])
+        else:
+            previous = data
+        yield {fieldname: status.get_value(data, fieldname, "-") for fieldname in fieldnames}
+
+
+def _previous_status(filenames, index):
+    for filename in reversed(filenames[:index]):
+        data = status.load_status(filename)
+        if UNCHANGED_MARKER not in data:
+            return data
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the vehicle status history store.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="import existing status files from the output directory")
+    import_parser.add_argument("--vin", help="only import a vehicle whose status is polled in fleet mode")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s", datefmt="%d-%b-%y %H:%M:%S")
+
+    if args.command == "import":
+        status_file = config.get("settings", "vehicle_status_file")
+        if args.vin is not None:
+            vins = [args.vin]
+        else:
+            # the configured vehicle, then each vehicle polled in fleet mode (in its own sub directory)
+            vins = [None] + sorted(set(
+                os.path.basename(os.path.dirname(filename))
+                for filename in glob.glob(status_filename_pattern(status.vehicle_status_file(status_file, "*")))
+            ))
+
+        history = History()
+        for vin in vins:
+            if vin is None:
+                filename_pattern = status_filename_pattern(status_file)
+                vin = config.get("car", "vin")
+            else:
+                filename_pattern = status_filename_pattern(status.vehicle_status_file(status_file, vin))
+            imported = history.import_files(filename_pattern, vin)
+            logging.info("Imported %d status files (vin: %s) into: %s", imported, vin, history.filename)
+        history.close()
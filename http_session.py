@@ -0,0 +1,80 @@
+import metrics
+import re
+import requests
+import threading
+import time
+from config import config
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from urllib3.util.retry import Retry
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def endpoint(url):
+    """Return the path of the url, without any vin, for use as a metric label."""
+    return re.sub(r"/vehicles/[^/]+", "/vehicles/{vin}", urlsplit(url).path)
+
+
+class TimeoutSession(requests.Session):
+    """A requests session that applies a default timeout to every request and records its metrics."""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        labels = {"method": method, "endpoint": endpoint(url)}
+        started = time.perf_counter()
+        try:
+            resp = super().request(method, url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            metrics.increment("http_request_errors_total", error=type(e).__name__, **labels)
+            raise
+        metrics.observe("http_request_duration_seconds", time.perf_counter() - started, **labels)
+        metrics.increment("http_requests_total", status=str(resp.status_code), **labels)
+        metrics.increment("http_response_bytes_total", len(resp.content), **labels)
+        return resp
+
+
+class CountingRetry(Retry):
+    """Retry that counts each retry in the metrics."""
+
+    def increment(self, method=None, url=None, *args, **kwargs):
+        # raises MaxRetryError once the retries have run out, so only retries that will be made are counted
+        retry = super().increment(method, url, *args, **kwargs)
+        metrics.increment("http_retries_total", method=method, endpoint=endpoint(url or ""))
+        return retry
+
+
+def create_session():
+    """Create a session with a connection pool and retries (with backoff) on 429 and 5xx responses.
+
+    Only idempotent requests are retried, so a charging command is never sent twice.
+    """
+    pool_size = config.getint("http", "pool_size", fallback=10)
+    retry = CountingRetry(
+        total=config.getint("http", "retries", fallback=3),
+        backoff_factor=config.getfloat("http", "backoff_factor", fallback=0.5),
+        status_forcelist=(429, 500, 502, 503, 504),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = TimeoutSession(config.getfloat("http", "timeout", fallback=30))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session():
+    """Return the session shared by all api calls, so connections are kept alive between calls."""
+    global _session
+    with _session_lock:
+        # the api calls of several commands may run at the same time, each in its own thread
+        if _session is None:
+            _session = create_session()
+    return _session
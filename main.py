@@ -1,7 +1,16 @@
+import time
+
+# the start time, taken before any other imports so that --profile-startup includes them
+STARTED = time.perf_counter()
+
+import argparse
+import importlib
 import logging
+import metrics
 import requests
+import status
 import sys
-from car import Car
+from datetime import datetime, timedelta
 
 logging.basicConfig(
     filename="log/car.log",
@@ -14,32 +23,212 @@ logging.basicConfig(
 logging.getLogger().addHandler(logging.StreamHandler())
 
 
-def main(command):
+# modules needed by each command, only imported when the command is run so that the frequent
+# (cron) commands do not pay for the imports of the others
+COMMAND_MODULES = {
+    "status": ["car", "command_queue"],
+    "start-charging": ["car", "command_queue"],
+    "stop-charging": ["car", "command_queue"],
+    "vehicles": ["car", "command_queue"],
+    "daemon": ["car", "command_queue", "daemon"],
+    "fleet-status": ["fleet"],
+    "report": ["reports"],
+    "history": ["csv", "history"],
+    "summary": ["rollups"]
+}
+
+# commands that call the api, run concurrently when several commands are given
+API_COMMANDS = ["status", "start-charging", "stop-charging", "vehicles", "fleet-status"]
+
+CHARGING_ACTIONS = {"start-charging": "start", "stop-charging": "stop"}
+
+
+def main(commands, args=None):
+    """Run the commands, e.g. vehicles status report.
+
+    The api calls of the commands run concurrently, each in its own thread, while the status and
+    vehicles files are written in the background (see writer.py). Once the api calls have finished
+    and the files have been written the report, history and summary commands are run, in the order
+    given. When status and a charging command are given together, the charging state is checked
+    using the status just fetched rather than fetching it again.
+    """
+    if commands == ["daemon"]:
+        from car import Car
+        from daemon import Daemon
+        run_command("daemon", Daemon(Car()).run)
+        return
+
+    import writer
+    from concurrent.futures import ThreadPoolExecutor
+
+    tasks = api_tasks(commands)
+    with ThreadPoolExecutor(max_workers=max(1, len(tasks))) as executor:
+        for command, task in tasks.items():
+            executor.submit(run_command, command, *task)
+    run_command("writing files", writer.wait)
+
+    # only once the api threads have finished (the writer thread is left idle, holding no locks),
+    # as the reports fork processes to read the statuses
+    for command in commands:
+        if command not in API_COMMANDS:
+            run_command(command, local_command, command, args)
+
+
+def api_tasks(commands):
+    """Return the function (and arguments) making the api calls of each command, by command."""
+    if not any(command in API_COMMANDS for command in commands):
+        return {}
+
+    from car import Car
     car = Car()
 
-    if command == "status":
-        car.get_status()
-    elif command == "start-charging":
-        car.set_charging("start")
-    elif command == "stop-charging":
-        car.set_charging("stop")
-    elif command == "vehicles":
-        car.get_vehicles()
+    tasks = {}
+    action = next((CHARGING_ACTIONS[command] for command in commands if command in CHARGING_ACTIONS), None)
+    if "status" in commands:
+        tasks["status"] = (get_status, car, action)
+    elif action is not None:
+        tasks[action + "-charging"] = (set_charging, car, action)
+    if "vehicles" in commands:
+        tasks["vehicles"] = (car.get_vehicles,)
+    if "fleet-status" in commands:
+        from fleet import Fleet
+        # sharing the car's tokens, so that they are only refreshed once
+        tasks["fleet-status"] = (Fleet(tokens=car.tokens).get_status,)
+    return tasks
+
+
+def get_status(car, action=None):
+    """Fetch the status, then send the queued (or given) charging action, checked against that status."""
+    from command_queue import CommandQueue
+
+    resp_json = car.get_status()
+    if action is None:
+        CommandQueue(car).process(resp_json)
     else:
-        print("Unsupported command: " + command)
+        # the status jobs may not include the charging status needed to check the action
+        CommandQueue(car).submit(action, resp_json if resp_json.get("charging") else None)
 
 
-if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        command = sys.argv[1]
+def set_charging(car, action):
+    from command_queue import CommandQueue
+    CommandQueue(car).submit(action)
+
+
+def local_command(command, args):
+    if command == "report":
+        from reports import Reports
+        Reports.generate_charge_report(vin=args.vin)
+    elif command == "history":
+        history(args)
+    elif command == "summary":
+        from rollups import Rollups
+        Rollups.print_summary(Rollups(args.vin).update())
     else:
-        print("No command specified")
-        exit(-1)
+        print("Unsupported command: " + command)
+
 
+def run_command(command, function, *args):
+    """Run the function, logging (rather than raising) any error so that the other commands carry on."""
     try:
-        main(command)
+        function(*args)
     except requests.exceptions.HTTPError as e:
         logging.error("Error: " + str(e))
     except Exception as e:
         logging.exception("Exception processing: " + command)
         logging.exception("Exception: " + str(e))
+
+
+def history(args):
+    """Write the requested fields of the statuses taken within the time range to stdout, as csv."""
+    import csv
+    from history import query_history
+
+    writer = csv.DictWriter(sys.stdout, fieldnames=args.fields)
+    writer.writeheader()
+    writer.writerows(query_history(args.start, args.end, args.fields, args.vin))
+
+
+def profile_startup(commands, args):
+    """Run the commands, logging how long their imports took and when their first request completed."""
+    imports_started = time.perf_counter()
+    for module in dict.fromkeys(module for command in commands for module in COMMAND_MODULES[command]):
+        importlib.import_module(module)
+    imports_finished = time.perf_counter()
+
+    first_response = []
+    if "http_session" in sys.modules:
+        def record_first_response(resp, *args, **kwargs):
+            if not first_response:
+                first_response.append((time.perf_counter(), resp.elapsed.total_seconds()))
+
+        sys.modules["http_session"].get_session().hooks["response"].append(record_first_response)
+
+    try:
+        main(commands, args)
+    finally:
+        finished = time.perf_counter()
+        logging.info(
+            "Startup profile: main imports %.1f ms, %s imports %.1f ms",
+            (imports_started - STARTED) * 1000, " ".join(commands), (imports_finished - imports_started) * 1000
+        )
+        if first_response:
+            received, elapsed = first_response[0]
+            logging.info(
+                "Startup profile: first response after %.1f ms (request took %.1f ms)",
+                (received - STARTED) * 1000, elapsed * 1000
+            )
+        logging.info("Startup profile: finished after %.1f ms", (finished - STARTED) * 1000)
+
+
+def parse_fields(value):
+    fieldnames = [fieldname.strip() for fieldname in value.split(",") if fieldname.strip()]
+    unknown = [fieldname for fieldname in fieldnames if fieldname not in status.STATUS_FIELDS]
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            "unknown field(s): {} (choose from: {})".format(", ".join(unknown), ", ".join(status.STATUS_FIELDS))
+        )
+    return fieldnames
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Control the car and fetch its status.")
+    parser.add_argument(
+        "commands",
+        nargs="+",
+        metavar="command",
+        choices=[
+            "status", "start-charging", "stop-charging", "vehicles", "daemon", "fleet-status", "report", "history",
+            "summary"
+        ],
+        help="one or more of: %(choices)s (e.g. vehicles status report)"
+    )
+    parser.add_argument("--from", dest="start", type=datetime.fromisoformat,
+                        help="history: local time of the first status, e.g. 2023-01-31T18:00 (default: a day earlier)")
+    parser.add_argument("--to", dest="end", type=datetime.fromisoformat,
+                        help="history: local time of the last status (default: now)")
+    parser.add_argument("--fields", type=parse_fields, default=status.REPORT_FIELDS,
+                        help="history: comma separated fields to show (default: the charge report fields)")
+    parser.add_argument("--vin", help="report, history, summary: use a vehicle whose status is polled in fleet mode")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="log how long the imports took and when the first request completed")
+    args = parser.parse_args()
+    commands = list(dict.fromkeys(args.commands))
+    if "daemon" in commands and len(commands) > 1:
+        parser.error("daemon cannot be combined with other commands")
+    if "start-charging" in commands and "stop-charging" in commands:
+        parser.error("start-charging and stop-charging cannot be combined")
+    if args.end is None:
+        args.end = datetime.now()
+    if args.start is None:
+        args.start = args.end - timedelta(days=1)
+
+    try:
+        if args.profile_startup:
+            profile_startup(commands, args)
+        else:
+            main(commands, args)
+    except Exception as e:
+        logging.exception("Exception processing: " + " ".join(commands))
+        logging.exception("Exception: " + str(e))
+    finally:
+        metrics.export()
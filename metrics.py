@@ -0,0 +1,204 @@
+"""Metrics about the api requests, tokens and files written, collected in memory and exported in bulk.
+
+The metrics are exported when a command finishes (and after each poll in daemon mode), as
+set by the export setting in the [metrics] section of config.ini:
+
+* prometheus: added to the totals held in a Prometheus text file, e.g. for the node
+  exporter's textfile collector, so the totals cover every run
+* jsonl: appended to a json lines metrics log, a line per export holding only the
+  metrics collected since the previous export
+"""
+
+import datetime
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+import time
+import writer
+from config import config
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "car_"
+
+# upper bounds (in seconds) of the buckets of the duration histograms
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+METRICS = {
+    # <metric name>                : (<type>, <help>)
+    "http_requests_total"          : ("counter", "Requests made, by endpoint and response status"),
+    "http_request_duration_seconds": ("histogram", "Time taken by each request, including any retries"),
+    "http_response_bytes_total"    : ("counter", "Bytes received in response bodies"),
+    "http_retries_total"           : ("counter", "Requests retried after an error or a 429/5xx response"),
+    "http_request_errors_total"    : ("counter", "Requests that failed without a response"),
+    "token_refreshes_total"        : ("counter", "Access tokens refreshed using the refresh token"),
+    "token_logins_total"           : ("counter", "Full web logins"),
+    "token_login_duration_seconds" : ("histogram", "Time taken by each full web login"),
+    "file_write_duration_seconds"  : ("histogram", "Time taken to write each file, by kind of file")
+}
+
+_lock = threading.Lock()
+_counters = {}      # (name, labels): value
+_histograms = {}    # (name, labels): [count per bucket..., count, sum]
+
+
+def increment(name, value=1, **labels):
+    """Add the value to a counter."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    """Add an observation (e.g. a duration in seconds) to a histogram."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.setdefault(key, [0] * (len(BUCKETS) + 2))
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[index] += 1
+        histogram[-2] += 1
+        histogram[-1] += value
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observe the time taken by the body of the with statement."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def export():
+    """Export the metrics collected since the last export."""
+    exporters = [exporter.strip() for exporter in config.get("metrics", "export", fallback="").split(",")]
+    with _lock:
+        samples = _samples()
+        _counters.clear()
+        _histograms.clear()
+    if not samples:
+        return
+
+    try:
+        if "prometheus" in exporters:
+            _export_prometheus(samples, config.get("metrics", "prometheus_file", fallback="output/metrics.prom"))
+        if "jsonl" in exporters:
+            _export_jsonl(samples, config.get("metrics", "jsonl_file", fallback="log/metrics.jsonl"))
+    except OSError as e:
+        logging.error("Unable to export metrics: %s", e)
+
+
+def _samples():
+    # the counters and histograms as samples, keyed by (metric name, sample name, labels)
+    samples = {}
+    for (name, labels), value in _counters.items():
+        samples[(name, PREFIX + name, labels)] = value
+    for (name, labels), histogram in _histograms.items():
+        for bound, count in zip(BUCKETS + ["+Inf"], histogram[:len(BUCKETS)] + [histogram[-2]]):
+            samples[(name, PREFIX + name + "_bucket", labels + (("le", str(bound)),))] = count
+        samples[(name, PREFIX + name + "_count", labels)] = histogram[-2]
+        samples[(name, PREFIX + name + "_sum", labels)] = histogram[-1]
+    return samples
+
+
+def _export_jsonl(samples, filename):
+    line = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "metrics": [
+            {"name": sample_name, "labels": dict(labels), "value": value}
+            for (name, sample_name, labels), value in sorted(samples.items(), key=_sort_key)
+        ]
+    }
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    with open(filename, "a") as f:
+        f.write(json.dumps(line) + "\n")
+
+
+_SAMPLE_LINE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def _export_prometheus(samples, filename):
+    # the file is locked while it is read and written, so that runs exporting at the same time
+    # (e.g. the daemon and a cron job) do not lose each other's counts
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    with open(filename + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            _merge_prometheus(samples, filename)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _merge_prometheus(samples, filename):
+    # add the samples to those already in the file, as each run only collects its own metrics
+    totals = _read_prometheus(filename)
+    for key, value in samples.items():
+        totals[key] = totals.get(key, 0) + value
+
+    lines = []
+    name = None
+    for (metric_name, sample_name, labels), value in sorted(totals.items(), key=_sort_key):
+        if metric_name != name:
+            name = metric_name
+            metric_type, metric_help = METRICS.get(name, ("untyped", ""))
+            lines.append(f"# HELP {PREFIX}{name} {metric_help}")
+            lines.append(f"# TYPE {PREFIX}{name} {metric_type}")
+        label_text = ",".join('{}="{}"'.format(label, _escape(label_value)) for label, label_value in labels)
+        value_text = str(int(value)) if float(value).is_integer() else repr(float(value))
+        lines.append(f"{sample_name}{{{label_text}}} {value_text}" if labels else f"{sample_name} {value_text}")
+
+    with writer.atomic_open(filename) as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def _sort_key(item):
+    # order the buckets of a histogram by their upper bound
+    (metric_name, sample_name, labels), value = item
+    return metric_name, sample_name, tuple(
+        (label, float(label_value)) if label == "le" else (label, label_value) for label, label_value in labels
+    )
+
+
+def _read_prometheus(filename):
+    totals = {}
+    if not os.path.isfile(filename):
+        return totals
+    with open(filename, "r") as f:
+        for line in f:
+            match = _SAMPLE_LINE.match(line.strip())
+            if not match:
+                continue
+            sample_name, label_text, value = match.groups()
+            labels = tuple(
+                (label, _unescape(label_value)) for label, label_value in _LABEL.findall(label_text or "")
+            )
+            if sample_name.endswith("_bucket"):
+                labels = tuple(sorted(label for label in labels if label[0] != "le")) \
+                    + tuple(label for label in labels if label[0] == "le")
+            else:
+                labels = tuple(sorted(labels))
+            totals[(_metric_name(sample_name), sample_name, labels)] = float(value)
+    return totals
+
+
+def _metric_name(sample_name):
+    name = sample_name[len(PREFIX):] if sample_name.startswith(PREFIX) else sample_name
+    for suffix in ("_bucket", "_count", "_sum"):
+        if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+            return name[:-len(suffix)]
+    return name
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _unescape(value):
+    return re.sub(r'\\(.)', lambda match: "\n" if match.group(1) == "n" else match.group(1), value)
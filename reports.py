@@ -1,24 +1,20 @@
-import configparser
+import argparse
+import bisect
 import csv
 import glob
 import json
 import os
 import logging
+import writer
 
+from collections import deque
+from config import config
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-
-logging.basicConfig(
-    filename="log/reports.log",
-    level=logging.INFO,
-    format="%(asctime)s - %(message)s",
-    datefmt="%d-%b-%y %H:%M:%S",
-    force=True
-)
-
-logging.getLogger().addHandler(logging.StreamHandler())
-
-config = configparser.ConfigParser()
-config.read("config.ini")
+from history import History
+from itertools import islice
+from rollups import Rollups
+from status import REPORT_FIELDS, load_details, status_filename_pattern, vehicle_status_file
 
 
 class ChargingSession:
@@ -31,22 +27,38 @@ class ChargingSession:
         self.start_range = None
         self.end_range = None
 
+    def to_dict(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, state):
+        charging_session = cls()
+        charging_session.__dict__.update(state)
+        return charging_session
+
+    def range_added(self):
+        if self.start_range is not None and self.end_range is not None:
+            return self.end_range - self.start_range
+        return "-"
+
+    def soc_added(self):
+        if self.start_soc is not None and self.end_soc is not None:
+            return self.end_soc - self.start_soc
+        return "-"
+
+    def duration(self):
+        return datetime.fromisoformat(self.end_time[:-1]) - datetime.fromisoformat(self.start_time[:-1])
+
     def print_summary(self):
         if self.start_time is None and self.end_time is None:
             print("No data available for this charging session.\n")
             return
 
-        range_added = "-"
-        if self.start_range is not None and self.end_range is not None:
-            range_added = self.end_range - self.start_range
-
-        soc_added = "-"
-        if self.start_soc is not None and self.end_soc is not None:
-            soc_added = self.end_soc - self.start_soc
+        range_added = self.range_added()
+        soc_added = self.soc_added()
 
         start_time = datetime.fromisoformat(self.start_time[:-1])
-        end_time = datetime.fromisoformat(self.end_time[:-1])
-        duration = end_time - start_time
+        duration = self.duration()
 
         weekday_name = start_time.strftime("%A")
         day_of_month = start_time.strftime("%d")
@@ -60,104 +72,383 @@ class ChargingSession:
         print(f"    Duration    : {duration} ({self.start_time} => {self.end_time})\n")
 
 
+class ReportSink:
+    """Somewhere the rows (one per status snapshot) and/or charging sessions of a report are written to."""
+
+    # the file written to, if any
+    filename = None
+
+    # whether only charging sessions are written
+    sessions_only = False
+
+    def write_row(self, details):
+        pass
+
+    def write_session(self, charging_session):
+        pass
+
+    def close(self):
+        pass
+
+
+class CsvSink(ReportSink):
+    """Write a csv row for each status snapshot."""
+
+    def __init__(self, filename, append):
+        self.filename = filename
+        self.file = open(filename, mode="a" if append else "w")
+        self.csv_writer = csv.DictWriter(
+            self.file,
+            fieldnames=REPORT_FIELDS,
+            extrasaction="ignore",
+            delimiter=",",
+            quotechar='"',
+            quoting=csv.QUOTE_MINIMAL
+        )
+        if not append:
+            self.csv_writer.writeheader()
+
+    def write_row(self, details):
+        self.csv_writer.writerow(details)
+
+    def close(self):
+        self.file.close()
+
+
+class JsonLinesSink(ReportSink):
+    """Write a json object (on its own line) for each status snapshot."""
+
+    def __init__(self, filename, append):
+        self.filename = filename
+        self.file = open(filename, mode="a" if append else "w")
+
+    def write_row(self, details):
+        self.file.write(json.dumps({fieldname: details[fieldname] for fieldname in REPORT_FIELDS}))
+        self.file.write("\n")
+
+    def close(self):
+        self.file.close()
+
+
+class SessionTableSink(ReportSink):
+    """Write a csv row for each charging session."""
+
+    sessions_only = True
+
+    fieldnames = [
+        "start_time", "end_time", "duration", "charge_type",
+        "start_soc_pct", "end_soc_pct", "soc_added_pct",
+        "start_range_km", "end_range_km", "range_added_km"
+    ]
+
+    def __init__(self, filename, append):
+        self.filename = filename
+        self.file = open(filename, mode="a" if append else "w")
+        self.csv_writer = csv.writer(self.file, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        if not append:
+            self.csv_writer.writerow(self.fieldnames)
+
+    def write_session(self, charging_session):
+        self.csv_writer.writerow([
+            charging_session.start_time,
+            charging_session.end_time,
+            charging_session.duration(),
+            charging_session.charge_type,
+            charging_session.start_soc,
+            charging_session.end_soc,
+            charging_session.soc_added(),
+            charging_session.start_range,
+            charging_session.end_range,
+            charging_session.range_added()
+        ])
+
+    def close(self):
+        self.file.close()
+
+
+class SessionSummarySink(ReportSink):
+    """Print a summary of each charging session."""
+
+    sessions_only = True
+
+    def write_session(self, charging_session):
+        charging_session.print_summary()
+
+
 class Reports:
-    """Generate reports based on historical vehicle and charge data."""
+    """Generate reports based on historical vehicle and charge data.
+
+    A report is a pipeline of generators. Status snapshots are read from the status files (or
+    the history store), their report fields are extracted, charging sessions are detected and
+    everything is streamed to one or more sinks, so memory use does not grow with the history.
+    """
+
+    # <sink name> : <sink class>
+    sink_types = {
+        "csv": CsvSink,
+        "jsonl": JsonLinesSink,
+        "sessions": SessionTableSink,
+        "summary": SessionSummarySink
+    }
 
     @staticmethod
-    def generate_charge_report():
-        """Generate a charge report based on historical charge report data files."""
+    def generate_charge_report(full=False, vin=None, sessions_only=False):
+        """Generate a charge report based on historical charge report data files.
+
+        Only status snapshots newer than the last checkpoint are processed and their rows
+        appended to the existing report. The report is rebuilt from all status snapshots
+        when ``full`` is set or when the checkpoint no longer matches the report.
+
+        If a ``vin`` is given the report covers the status snapshots stored for that vehicle
+        in fleet mode, and is stored separately from the default report.
+
+        The report is written to the sinks listed in the [reports] section of config.ini, or
+        only to those that write charging sessions when ``sessions_only`` is set. A sessions only
+        report keeps its own checkpoint and files (e.g. charge_sessions_only.csv), so that it does
+        not force the full report to be rebuilt, nor append to the files of the full report.
+        """
 
         logging.info("Generating a charge report\n")
-        report_filename = "reports/charge_report.csv"
-
-        with open(report_filename, mode="w") as csv_charge_file:
-            fields = {
-                # <csv header name>              : <path to value within status data>
-                "timestamp"                      : ["requestTimestamp"],
-                "car_captured_timestamp"         : ["charging", "chargingStatus", "value", "carCapturedTimestamp"],
-                "odometer"                       : ["measurements", "odometerStatus", "value", "odometer"],
-                "plug_connection_state"          : ["charging", "plugStatus", "value", "plugConnectionState"],
-                "charging_state"                 : ["charging", "chargingStatus", "value", "chargingState"],
-                "plug_lock_state"                : ["charging", "plugStatus", "value", "plugLockState"],
-                "max_charge_current_ac"          : ["charging", "chargingSettings", "value", "maxChargeCurrentAC"],
-                "charge_type"                    : ["charging", "chargingStatus", "value", "chargeType"],
-                "charge_power_kw"                : ["charging", "chargingStatus", "value", "chargePower_kW"],
-                "charge_rate_kmph"               : ["charging", "chargingStatus", "value", "chargeRate_kmph"],
-                "target_soc_pct"                 : ["charging", "chargingSettings", "value", "targetSOC_pct"],
-                "current_soc_pct"                : ["charging", "batteryStatus", "value", "currentSOC_pct"],
-                "remaining_charging_time_m"      : ["charging", "chargingStatus", "value", "remainingChargingTimeToComplete_min"],
-                "cruising_range_electric_km"     : ["charging", "batteryStatus", "value", "cruisingRangeElectric_km"],
-                "climatisation_state"            : ["climatisation", "climatisationStatus", "value", "climatisationState"],
-                "remaining_climatisation_time_m" : ["climatisation", "climatisationStatus", "value", "remainingClimatisationTime_min"]
+        checkpoint_filename = config.get("settings", "charge_report_checkpoint_file",
+                                         fallback="reports/charge_report_checkpoint.json")
+        status_file = config.get("settings", "vehicle_status_file")
+        if vin is not None:
+            checkpoint_filename = Reports._vin_filename(checkpoint_filename, vin)
+            status_file = vehicle_status_file(status_file, vin)
+
+        sink_names = [name.strip() for name in config.get("reports", "sinks", fallback="csv,summary").split(",")]
+        if sessions_only:
+            sink_names = [name for name in sink_names if Reports.sink_types[name].sessions_only] or ["summary"]
+            checkpoint_filename = Reports._vin_filename(checkpoint_filename, "sessions_only")
+        sink_filenames = {name: Reports._sink_filename(name, vin, sessions_only) for name in sink_names}
+
+        checkpoint = None
+        if not full:
+            checkpoint = Reports._load_checkpoint(checkpoint_filename, sink_filenames)
+
+        if checkpoint is None:
+            logging.info("Rebuilding charge report from all status data")
+            progress = {
+                "last_filename": None,
+                "last_details": None,
+                "charging_session": ChargingSession()
+            }
+        else:
+            progress = {
+                "last_filename": checkpoint["last_filename"],
+                "last_details": checkpoint["last_details"],
+                "charging_session": ChargingSession.from_dict(checkpoint["charging_session"])
             }
 
-            csv_writer = csv.DictWriter(
-                csv_charge_file,
-                fieldnames=fields.keys(),
-                extrasaction="ignore",
-                delimiter=",",
-                quotechar='"',
-                quoting=csv.QUOTE_MINIMAL
-            )
-
-            csv_writer.writeheader()
-
-            status_filename = config.get("settings", "vehicle_status_file")
-            filename_pattern = status_filename[:status_filename.find("%")] \
-                + "*" \
-                + status_filename[status_filename.rfind("."):]
-
-            charging_session = ChargingSession()
-
-            for filename in sorted(glob.glob(filename_pattern)):
-                with open(os.path.join(os.getcwd(), filename), "r") as json_file:
-                    # logging.info("Processing status file: %s", filename)
-
-                    data = json.load(json_file)
-
-                    # if "data" not in data or not data["data"]:
-                    #     continue
-
-                    pre_2022dec_format = False
-                    if "data" in data:
-                        pre_2022dec_format = True
-
-                    details = {}
-
-                    for fieldname, value_keys in fields.items():
-                        value = data
-                        for idx, value_key in enumerate(value_keys):
-                            if idx == 0 and len(value_keys) > 1 and pre_2022dec_format:
-                                value_key = "data"
-                            if value_key == "value" and pre_2022dec_format:
-                                continue
-                            if value_key not in value:
-                                # raise RuntimeError("Unable to find '{}' value using path: {}".format(fieldname, value_keys))
-                                value = "-"
-                            else:
-                                value = value[value_key]
-                        details[fieldname] = value
-
-                    if details["charging_state"] == "charging":
-                        # start of new session or continuation of existing
-                        if charging_session.start_time is None:
-                            charging_session.start_time = details["car_captured_timestamp"]
-                            charging_session.charge_type = details["charge_type"]
-                            charging_session.start_soc = details["current_soc_pct"]
-                            charging_session.start_range = details["cruising_range_electric_km"]
-                    else:
-                        if charging_session.start_time is not None:
-                            # end of existing session
-                            charging_session.end_time = details["car_captured_timestamp"]
-                            charging_session.end_soc = details["current_soc_pct"]
-                            charging_session.end_range = details["cruising_range_electric_km"]
-                            charging_session.print_summary()
-                            charging_session = ChargingSession()
-
-                    csv_writer.writerow(details)
-
-        logging.info("Charge report stored at: %s", report_filename)
+        append = checkpoint is not None
+        sinks = []
+        for name in sink_names:
+            if sink_filenames[name] is None:
+                sinks.append(Reports.sink_types[name]())
+            else:
+                sinks.append(Reports.sink_types[name](sink_filenames[name], append))
+        row_sinks = [sink for sink in sinks if not sink.sessions_only]
+
+        # status source (and field extractor) => unchanged status filler => session detector => sinks
+        rows = Reports._status_details(status_filename_pattern(status_file), after=progress["last_filename"])
+        rows = Reports._fill_unchanged(rows, progress)
+        processed = 0
+        try:
+            for details, ended_session in Reports._detect_sessions(rows, progress):
+                if ended_session is not None:
+                    for sink in sinks:
+                        sink.write_session(ended_session)
+                for sink in row_sinks:
+                    sink.write_row(details)
+                processed += 1
+        finally:
+            for sink in sinks:
+                sink.close()
+
+        logging.info("Processed %d new status snapshots", processed)
+
+        # remember where we got to (including any charging session still in progress)
+        Reports._save_checkpoint(checkpoint_filename, {
+            "last_filename": progress["last_filename"],
+            "charging_session": progress["charging_session"].to_dict(),
+            "last_details": progress["last_details"],
+            "fields": REPORT_FIELDS,
+            "sinks": sink_names,
+            "outputs": {sink.filename: os.path.getsize(sink.filename) for sink in sinks if sink.filename}
+        })
+
+        for sink in sinks:
+            if sink.filename:
+                logging.info("Charge report stored at: %s", sink.filename)
+
+        # the daily rollups only read the days that have received new status snapshots
+        Rollups(vin).update()
+
+    @staticmethod
+    def status_details(vin=None):
+        """Yield the report fields of every status snapshot in time order, as the charge report reads them.
+
+        An unchanged status marker has the report fields of the snapshot before it. If a ``vin`` is
+        given the snapshots stored for that vehicle in fleet mode are read.
+        """
+
+        status_file = config.get("settings", "vehicle_status_file")
+        if vin is not None:
+            status_file = vehicle_status_file(status_file, vin)
+        progress = {"last_filename": None, "last_details": None}
+        yield from Reports._fill_unchanged(Reports._status_details(status_filename_pattern(status_file)), progress)
+
+    @staticmethod
+    def _sink_filename(name, vin, sessions_only=False):
+        """Return the file written to by the named sink, or None if it does not write to a file."""
+
+        report_filename = config.get("settings", "charge_report_file", fallback="reports/charge_report.csv")
+        filenames = {
+            "csv": report_filename,
+            "jsonl": os.path.splitext(report_filename)[0] + ".jsonl",
+            "sessions": config.get("settings", "charge_sessions_file", fallback="reports/charge_sessions.csv")
+        }
+        filename = filenames.get(name)
+        if filename is not None and vin is not None:
+            filename = Reports._vin_filename(filename, vin)
+        if filename is not None and sessions_only:
+            filename = Reports._vin_filename(filename, "only")
+        return filename
+
+    @staticmethod
+    def _fill_unchanged(rows, progress):
+        """Yield the report fields of each snapshot.
+
+        The report fields of an unchanged status marker are taken from the previous snapshot.
+        """
+
+        for filename, details in rows:
+            if "unchanged_since" in details and progress["last_details"] is not None:
+                # the car has not reported anything new since the previous status
+                details = dict(progress["last_details"], timestamp=details["timestamp"])
+            progress["last_filename"] = filename
+            progress["last_details"] = details
+            yield details
+
+    @staticmethod
+    def _detect_sessions(rows, progress):
+        """Yield (report fields, charging session ended by the snapshot or None) for each snapshot."""
+
+        for details in rows:
+            charging_session = progress["charging_session"]
+            ended_session = None
+            if details["charging_state"] == "charging":
+                # start of new session or continuation of existing
+                if charging_session.start_time is None:
+                    charging_session.start_time = details["car_captured_timestamp"]
+                    charging_session.charge_type = details["charge_type"]
+                    charging_session.start_soc = details["current_soc_pct"]
+                    charging_session.start_range = details["cruising_range_electric_km"]
+            else:
+                if charging_session.start_time is not None:
+                    # end of existing session
+                    charging_session.end_time = details["car_captured_timestamp"]
+                    charging_session.end_soc = details["current_soc_pct"]
+                    charging_session.end_range = details["cruising_range_electric_km"]
+                    ended_session = charging_session
+                    progress["charging_session"] = ChargingSession()
+            yield details, ended_session
+
+    @staticmethod
+    def _status_details(filename_pattern, after=None):
+        """Yield (filename, report fields) in time order for each status snapshot matching the pattern after ``after``.
+
+        Snapshots are read from the history store when status data is stored there, otherwise
+        from the individual status files.
+        """
+
+        if config.get("settings", "status_store", fallback="file") in ("history", "both"):
+            history = History()
+            try:
+                yield from history.details(filename_pattern, after=after)
+            finally:
+                history.close()
+            return
+
+        status_filenames = sorted(glob.glob(filename_pattern))
+        if after is not None:
+            status_filenames = status_filenames[bisect.bisect_right(status_filenames, after):]
+
+        chunk_size = config.getint("reports", "chunk_size", fallback=500)
+        workers = config.getint("reports", "workers", fallback=0) or os.cpu_count()
+        remaining = iter(status_filenames)
+        chunks = iter(lambda: list(islice(remaining, chunk_size)), [])
+
+        if workers == 1 or len(status_filenames) <= chunk_size:
+            for chunk in chunks:
+                yield from zip(chunk, load_details(chunk))
+            return
+
+        # parse chunks of status files in parallel, keeping a bounded number of chunks
+        # in flight and consuming the results in their original (time) order
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for chunk in chunks:
+                pending.append((chunk, executor.submit(load_details, chunk)))
+                if len(pending) >= workers * 2:
+                    break
+            while pending:
+                chunk, future = pending.popleft()
+                next_chunk = next(chunks, None)
+                if next_chunk is not None:
+                    pending.append((next_chunk, executor.submit(load_details, next_chunk)))
+                yield from zip(chunk, future.result())
+
+    @staticmethod
+    def _vin_filename(filename, vin):
+        root, ext = os.path.splitext(filename)
+        return f"{root}_{vin}{ext}"
+
+    @staticmethod
+    def _load_checkpoint(checkpoint_filename, sink_filenames):
+        """Load the charge report checkpoint, returning None if the report needs a full rebuild."""
+
+        if not os.path.isfile(checkpoint_filename):
+            return None
+
+        with open(checkpoint_filename, "r") as f:
+            checkpoint = json.load(f)
+
+        if checkpoint.get("last_filename") is None \
+                or checkpoint.get("fields") != REPORT_FIELDS \
+                or checkpoint.get("sinks") != list(sink_filenames):
+            return None
+
+        for filename in sink_filenames.values():
+            if filename is None:
+                continue
+            if not os.path.isfile(filename) or checkpoint["outputs"].get(filename) != os.path.getsize(filename):
+                logging.warning("Charge report has been modified since the last checkpoint: %s", filename)
+                return None
+
+        return checkpoint
+
+    @staticmethod
+    def _save_checkpoint(checkpoint_filename, checkpoint):
+        with writer.atomic_open(checkpoint_filename) as f:
+            json.dump(checkpoint, f, sort_keys=True, indent=4)
 
 
 if __name__ == "__main__":
-    Reports.generate_charge_report()
+    parser = argparse.ArgumentParser(description="Generate reports from historical vehicle status data.")
+    parser.add_argument("--full", action="store_true", help="rebuild the charge report from all status files")
+    parser.add_argument("--vin", help="report on a single vehicle whose status is polled in fleet mode")
+    parser.add_argument("--sessions-only", action="store_true", help="only report on charging sessions")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        filename="log/reports.log",
+        level=logging.INFO,
+        format="%(asctime)s - %(message)s",
+        datefmt="%d-%b-%y %H:%M:%S",
+        force=True
+    )
+
+    logging.getLogger().addHandler(logging.StreamHandler())
+
+    Reports.generate_charge_report(full=args.full, vin=args.vin, sessions_only=args.sessions_only)
@@ -0,0 +1,201 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import status
+import writer
+from concurrent.futures import ProcessPoolExecutor
+from config import config
+from datetime import datetime
+from history import History
+
+logger = logging.getLogger(__name__)
+
+# bump when the daily rollup changes, so that cached rollups are rebuilt
+ROLLUP_VERSION = 2
+
+# number of days whose snapshots are read at a time
+BATCH_DAYS = 64
+
+# fields whose last known value is carried over snapshots that are missing them
+CARRIED_FIELDS = ["current_soc_pct", "cruising_range_electric_km", "odometer"]
+
+ROLLUP_FIELDS = ["snapshots", "sessions", "soc_added_pct", "range_added_km", "odometer_km", "plugged_in_h"]
+
+
+class Rollups:
+    """Daily and monthly summaries of the status history, cached so that past days are not read again.
+
+    Each day's rollup is kept with a fingerprint of the status snapshots it was made from (their
+    filenames and sizes) and the last snapshot of the day before, as sessions and distances carry
+    over from one day to the next. A day is only rolled up again when its fingerprint or the day
+    before's last snapshot has changed, i.e. when it has received new snapshots.
+    """
+
+    def __init__(self, vin=None):
+        self.status_file = config.get("settings", "vehicle_status_file")
+        self.rollup_file = config.get("settings", "rollup_file", fallback="reports/rollups.json")
+        if vin is not None:
+            self.status_file = status.vehicle_status_file(self.status_file, vin)
+            root, ext = os.path.splitext(self.rollup_file)
+            self.rollup_file = f"{root}_{vin}{ext}"
+        self.filename_pattern = status.status_filename_pattern(self.status_file)
+        self.from_history = config.get("settings", "status_store", fallback="file") in ("history", "both")
+
+    def update(self):
+        """Bring the daily rollups up to date with the status history, returning them by day (YYYY-MM-DD)."""
+
+        cached = self._load()
+        days = self._days()
+
+        changed = [day for day, snapshots in days.items()
+                   if cached.get(day, {}).get("fingerprint") != Rollups._fingerprint(snapshots)]
+
+        rollups = {}
+        details = {}
+        previous = None
+        for day, snapshots in days.items():
+            rollup = cached.get(day)
+            fingerprint = Rollups._fingerprint(snapshots)
+            if rollup is None or rollup["fingerprint"] != fingerprint or rollup["previous"] != previous:
+                if day not in details:
+                    # read the snapshots of this day and the next few changed days in parallel
+                    batch = [day] + [changed_day for changed_day in changed if changed_day > day][:BATCH_DAYS - 1]
+                    details.update(self._load_details({batch_day: days[batch_day] for batch_day in batch}))
+                rollup = dict(Rollups._roll_up(details.pop(day), previous), fingerprint=fingerprint, previous=previous)
+                logging.info("Rolled up %s (%d snapshots)", day, rollup["snapshots"])
+            rollups[day] = rollup
+            previous = rollup["last"]
+
+        if rollups != cached:
+            self._save(rollups)
+        return rollups
+
+    @staticmethod
+    def monthly(rollups):
+        """Return the totals of the daily rollups for each month (YYYY-MM)."""
+        months = {}
+        for day, rollup in rollups.items():
+            month = months.setdefault(day[:7], dict.fromkeys(ROLLUP_FIELDS, 0))
+            for field in ROLLUP_FIELDS:
+                month[field] += rollup[field]
+        return months
+
+    @staticmethod
+    def print_summary(rollups, days=7):
+        """Print the monthly totals and the rollups of the last few days."""
+        header = "{:<10} {:>9} {:>8} {:>9} {:>9} {:>9} {:>10}".format(
+            "", "snapshots", "sessions", "soc added", "range km", "distance", "plugged h")
+        row = "{:<10} {snapshots:>9} {sessions:>8} {soc_added_pct:>8}% {range_added_km:>9} {odometer_km:>9} " \
+              "{plugged_in_h:>10.1f}"
+
+        print(header)
+        for month, totals in Rollups.monthly(rollups).items():
+            print(row.format(month, **totals))
+        print()
+        print(header)
+        for day in list(rollups)[-days:]:
+            print(row.format(day, **{field: rollups[day][field] for field in ROLLUP_FIELDS}))
+
+    def _days(self):
+        # (filename, size) of each status snapshot, by day, in time order
+        if self.from_history:
+            history = History()
+            try:
+                snapshots = list(history.sizes(self.filename_pattern))
+            finally:
+                history.close()
+        else:
+            snapshots = [(filename, os.path.getsize(filename)) for filename in sorted(glob.glob(self.filename_pattern))]
+
+        days = {}
+        for filename, size in snapshots:
+            days.setdefault(self._day(filename), []).append((filename, size))
+        return days
+
+    def _day(self, filename):
+        # the status filenames are named after the (local) time each status was taken
+        return datetime.strptime(status.uncompressed_filename(filename), self.status_file).strftime("%Y-%m-%d")
+
+    def _load_details(self, days):
+        # the report fields of each snapshot, by day
+        if not days:
+            return {}
+        if self.from_history:
+            history = History()
+            try:
+                return {
+                    day: list(history.query(self.filename_pattern, snapshots[0][0], snapshots[-1][0],
+                                            status.REPORT_FIELDS))
+                    for day, snapshots in days.items()
+                }
+            finally:
+                history.close()
+
+        filenames = [[filename for filename, size in snapshots] for snapshots in days.values()]
+        workers = config.getint("reports", "workers", fallback=0) or os.cpu_count()
+        if workers == 1 or len(days) == 1:
+            return dict(zip(days, map(status.load_details, filenames)))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return dict(zip(days, executor.map(status.load_details, filenames, chunksize=8)))
+
+    @staticmethod
+    def _roll_up(rows, previous):
+        # a day's totals, each interval between snapshots counting towards the day of the later one
+        rollup = dict.fromkeys(ROLLUP_FIELDS, 0)
+        for details in rows:
+            if "unchanged_since" in details:
+                details = dict(previous or details, timestamp=details["timestamp"])
+                details.pop("unchanged_since", None)
+            if previous is not None:
+                # so that a change across a snapshot missing a value is still counted
+                details = dict(details, **{
+                    fieldname: previous[fieldname] for fieldname in CARRIED_FIELDS
+                    if not Rollups._is_number(details[fieldname]) and Rollups._is_number(previous[fieldname])
+                })
+            rollup["snapshots"] += 1
+            charging = details["charging_state"] == "charging"
+            if charging and (previous is None or previous["charging_state"] != "charging"):
+                rollup["sessions"] += 1
+            if previous is not None:
+                if previous["charging_state"] == "charging":
+                    rollup["soc_added_pct"] += Rollups._increase(previous, details, "current_soc_pct")
+                    rollup["range_added_km"] += Rollups._increase(previous, details, "cruising_range_electric_km")
+                rollup["odometer_km"] += max(0, Rollups._increase(previous, details, "odometer"))
+                if previous["plug_connection_state"] == "connected":
+                    rollup["plugged_in_h"] += (
+                        datetime.fromisoformat(details["timestamp"][:-1])
+                        - datetime.fromisoformat(previous["timestamp"][:-1])
+                    ).total_seconds() / 3600
+            previous = details
+        rollup["last"] = previous
+        return rollup
+
+    @staticmethod
+    def _increase(previous, details, fieldname):
+        before, after = previous[fieldname], details[fieldname]
+        if Rollups._is_number(before) and Rollups._is_number(after):
+            return after - before
+        return 0
+
+    @staticmethod
+    def _is_number(value):
+        return isinstance(value, (int, float))
+
+    @staticmethod
+    def _fingerprint(snapshots):
+        return hashlib.sha1("\n".join(f"{filename}:{size}" for filename, size in snapshots).encode()).hexdigest()
+
+    def _load(self):
+        if not os.path.isfile(self.rollup_file):
+            return {}
+        with open(self.rollup_file, "r") as f:
+            cache = json.load(f)
+        if cache.get("version") != ROLLUP_VERSION or cache.get("status_file") != self.status_file:
+            return {}
+        return cache["days"]
+
+    def _save(self, rollups):
+        with writer.atomic_open(self.rollup_file) as f:
+            json.dump({"version": ROLLUP_VERSION, "status_file": self.status_file, "days": rollups}, f)
@@ -0,0 +1,226 @@
+"""Helpers for extracting values from vehicle status data.
+
+Two status formats are supported:
+
+* pre 2022-Dec: all groups are nested under a top-level "data" key and values are not
+  wrapped in a "value" object, e.g. data > chargingStatus > chargingState
+* current: groups are nested under their job name and values are wrapped in a "value"
+  object, e.g. charging > chargingStatus > value > chargingState
+
+Every field is declared once in STATUS_FIELDS using its path in the current format. The
+path is compiled into a getter for each format when this module is loaded, so looking up
+a value is a single chain of subscripts rather than a walk over its path.
+"""
+
+import gzip
+import json
+import os
+
+STATUS_FIELDS = {
+    # <field name>                   : <path to value within status data>
+    "timestamp"                      : ["requestTimestamp"],
+    "car_captured_timestamp"         : ["charging", "chargingStatus", "value", "carCapturedTimestamp"],
+    "odometer"                       : ["measurements", "odometerStatus", "value", "odometer"],
+    "plug_connection_state"          : ["charging", "plugStatus", "value", "plugConnectionState"],
+    "charging_state"                 : ["charging", "chargingStatus", "value", "chargingState"],
+    "plug_lock_state"                : ["charging", "plugStatus", "value", "plugLockState"],
+    "max_charge_current_ac"          : ["charging", "chargingSettings", "value", "maxChargeCurrentAC"],
+    "charge_type"                    : ["charging", "chargingStatus", "value", "chargeType"],
+    "charge_power_kw"                : ["charging", "chargingStatus", "value", "chargePower_kW"],
+    "charge_rate_kmph"               : ["charging", "chargingStatus", "value", "chargeRate_kmph"],
+    "target_soc_pct"                 : ["charging", "chargingSettings", "value", "targetSOC_pct"],
+    "current_soc_pct"                : ["charging", "batteryStatus", "value", "currentSOC_pct"],
+    "remaining_charging_time_m"      : ["charging", "chargingStatus", "value", "remainingChargingTimeToComplete_min"],
+    "cruising_range_electric_km"     : ["charging", "batteryStatus", "value", "cruisingRangeElectric_km"],
+    "climatisation_state"            : ["climatisation", "climatisationStatus", "value", "climatisationState"],
+    "remaining_climatisation_time_m" : ["climatisation", "climatisationStatus", "value", "remainingClimatisationTime_min"],  # noqa: E501
+    "charge_mode"                    : ["charging", "chargingStatus", "value", "chargeMode"],
+    "battery_status_timestamp"       : ["charging", "batteryStatus", "value", "carCapturedTimestamp"],
+    "total_range_km"                 : ["fuelStatus", "rangeStatus", "value", "totalRange_km"]
+}
+
+# fields (and their order) within the charge report
+REPORT_FIELDS = [
+    "timestamp",
+    "car_captured_timestamp",
+    "odometer",
+    "plug_connection_state",
+    "charging_state",
+    "plug_lock_state",
+    "max_charge_current_ac",
+    "charge_type",
+    "charge_power_kw",
+    "charge_rate_kmph",
+    "target_soc_pct",
+    "current_soc_pct",
+    "remaining_charging_time_m",
+    "cruising_range_electric_km",
+    "climatisation_state",
+    "remaining_climatisation_time_m"
+]
+
+# key of the marker stored in place of a status that is unchanged since the previous one
+UNCHANGED_MARKER = "unchangedSince"
+
+# suffix added to the status filename for each compressed status format
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+_MISSING = object()
+
+
+def _pre_2022dec_path(value_keys):
+    if len(value_keys) > 1:
+        value_keys = ["data"] + value_keys[1:]
+    return [value_key for value_key in value_keys if value_key != "value"]
+
+
+def _compile_getter(value_keys):
+    # the equivalent of: data["charging"]["chargingStatus"]["value"]["chargingState"], the keys of
+    # the status paths (4 in the current format, 3 in the pre 2022-Dec format) bound up front
+    if len(value_keys) == 4:
+        key1, key2, key3, key4 = value_keys
+
+        def getter(data, default):
+            try:
+                return data[key1][key2][key3][key4]
+            except (KeyError, TypeError):
+                return default
+    elif len(value_keys) == 3:
+        key1, key2, key3 = value_keys
+
+        def getter(data, default):
+            try:
+                return data[key1][key2][key3]
+            except (KeyError, TypeError):
+                return default
+    else:
+        value_keys = tuple(value_keys)
+
+        def getter(data, default):
+            try:
+                for value_key in value_keys:
+                    data = data[value_key]
+                return data
+            except (KeyError, TypeError):
+                return default
+    return getter
+
+
+_GETTERS = {
+    fieldname: _compile_getter(value_keys) for fieldname, value_keys in STATUS_FIELDS.items()
+}
+_PRE_2022DEC_GETTERS = {
+    fieldname: _compile_getter(_pre_2022dec_path(value_keys)) for fieldname, value_keys in STATUS_FIELDS.items()
+}
+
+_REPORT_GETTERS = [(fieldname, _GETTERS[fieldname]) for fieldname in REPORT_FIELDS]
+_PRE_2022DEC_REPORT_GETTERS = [(fieldname, _PRE_2022DEC_GETTERS[fieldname]) for fieldname in REPORT_FIELDS]
+
+
+def is_pre_2022dec_format(data):
+    return "data" in data
+
+
+def get_value(data, fieldname, default=_MISSING):
+    """Return a field's value from the status data.
+
+    A KeyError is raised if the value is missing and no default is given.
+    """
+    getters = _PRE_2022DEC_GETTERS if is_pre_2022dec_format(data) else _GETTERS
+    value = getters[fieldname](data, default)
+    if value is _MISSING:
+        raise KeyError(fieldname)
+    return value
+
+
+def get_values(data, fieldnames, default=None):
+    """Return the values of the fields from the status data, using the default for any that are missing."""
+    getters = _PRE_2022DEC_GETTERS if is_pre_2022dec_format(data) else _GETTERS
+    return {fieldname: getters[fieldname](data, default) for fieldname in fieldnames}
+
+
+def status_filename_pattern(status_filename):
+    """Return a glob pattern matching all the status files named using the status filename format.
+
+    Compressed status files (e.g. .json.gz) are matched too.
+    """
+    return status_filename[:status_filename.find("%")] \
+        + "*" \
+        + status_filename[status_filename.rfind("."):] \
+        + "*"
+
+
+def vehicle_status_file(status_filename, vin):
+    """Return the status filename format for a vehicle's own sub directory."""
+    directory, basename = os.path.split(status_filename)
+    return os.path.join(directory, vin, basename)
+
+
+def captured_timestamps(data):
+    """Return every carCapturedTimestamp within the status data, sorted."""
+    timestamps = []
+    values = [data]
+    while values:
+        value = values.pop()
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if key == "carCapturedTimestamp":
+                    timestamps.append(str(item))
+                elif isinstance(item, (dict, list)):
+                    values.append(item)
+        elif isinstance(value, list):
+            values.extend(value)
+    return sorted(timestamps)
+
+
+def unchanged_marker(request_timestamp, unchanged_since):
+    """Return the marker stored in place of an unchanged status.
+
+    The marker refers to the status requested at ``unchanged_since``.
+    """
+    return {"requestTimestamp": request_timestamp, UNCHANGED_MARKER: unchanged_since}
+
+
+def extract_details(data):
+    """Return the report fields found in the status data, using "-" for any missing values.
+
+    The details of an unchanged status marker also hold its "unchanged_since" timestamp.
+    """
+
+    if UNCHANGED_MARKER in data:
+        details = dict.fromkeys(REPORT_FIELDS, "-")
+        details["timestamp"] = data["requestTimestamp"]
+        details["unchanged_since"] = data[UNCHANGED_MARKER]
+        return details
+
+    report_getters = _PRE_2022DEC_REPORT_GETTERS if is_pre_2022dec_format(data) else _REPORT_GETTERS
+    return {fieldname: getter(data, "-") for fieldname, getter in report_getters}
+
+
+def uncompressed_filename(filename):
+    """Return the name of a status file without any compression suffix, i.e. the name it is stored under."""
+    for suffix in COMPRESSION_SUFFIXES.values():
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+
+def load_status(filename):
+    """Return the status data held in a status file, which may be gzip (.gz) or zstd (.zst) compressed."""
+
+    if filename.endswith(COMPRESSION_SUFFIXES["gzip"]):
+        with gzip.open(filename, "rb") as f:
+            return json.load(f)
+    if filename.endswith(COMPRESSION_SUFFIXES["zstd"]):
+        # optional dependency, only needed for the zstd status format
+        import zstandard
+        with open(filename, "rb") as f:
+            return json.loads(zstandard.ZstdDecompressor().decompress(f.read()))
+    with open(filename, "rb") as f:
+        return json.load(f)
+
+
+def load_details(filenames):
+    """Return the report fields for each of the status files, in the same order."""
+
+    return [extract_details(load_status(filename)) for filename in filenames]
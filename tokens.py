@@ -1,34 +1,45 @@
-import configparser
+import base64
+import http_session
+import os
 import re
 import requests
 import json
-import secrets
+import metrics
+import threading
+import time
 import urllib.parse as urlparse
+import writer
 from urllib.parse import parse_qs
-from bs4 import BeautifulSoup
+from config import config
 from pathlib import Path
 import logging
 
 logger = logging.getLogger(__name__)
 
-config = configparser.ConfigParser()
-config.read("config.ini")
-
-user_agent = config.get("url", "user_agent")
-login_url = config.get("url", "login")
-identity_url = config.get("url", "identity")
-
 
 class Tokens:
+    """Access and refresh tokens, stored in the token file and shared by all api calls.
+
+    The access token is refreshed shortly before it expires rather than waiting for an api
+    call to be rejected. Only one refresh happens at a time: concurrent callers wait for it
+    and then use the new access token.
+    """
 
     def __init__(self):
         self.tokens = {}
+        self.token_file_mtime = None
+        self.lock = threading.RLock()
         self.load_tokens_from_file()
 
     def get_access_token(self):
-        if "accessToken" not in self.tokens:
-            self.load_tokens_from_web()
-        return self.tokens["accessToken"]
+        with self.lock:
+            self._reload_if_changed()
+            if "accessToken" not in self.tokens:
+                self.load_tokens_from_web()
+            elif self._access_token_expires_soon():
+                logging.info("Access token is about to expire")
+                self._refresh_tokens()
+            return self.tokens["accessToken"]
 
     def get_refresh_token(self):
         if "refreshToken" not in self.tokens:
@@ -42,23 +53,71 @@ class Tokens:
             logging.info("Retrieving tokens from file: %s", token_file)
             with open(token_file) as f:
                 self.tokens = json.load(f)
+            self.token_file_mtime = path.stat().st_mtime
+
+    def _reload_if_changed(self):
+        # pick up tokens refreshed by another process since they were last read
+        token_file = config.get("settings", "token_file")
+        try:
+            mtime = os.stat(token_file).st_mtime
+        except FileNotFoundError:
+            return
+        if mtime != self.token_file_mtime:
+            self.load_tokens_from_file()
+
+    def _save_tokens(self, tokens):
+        # only readable by the owner, as it holds the tokens
+        token_file = config.get("settings", "token_file")
+        with metrics.timer("file_write_duration_seconds", file="tokens"):
+            with writer.atomic_open(token_file, permissions=0o600) as f:
+                json.dump(tokens, f)
+        self.tokens = tokens
+        self.token_file_mtime = os.stat(token_file).st_mtime
+
+    def _access_token_expires_soon(self):
+        expiry = Tokens._jwt_expiry(self.tokens["accessToken"])
+        if expiry is None:
+            # not a jwt, so rely on the api rejecting it once it has expired
+            return False
+        margin = config.getint("settings", "token_refresh_margin", fallback=300)
+        return time.time() + margin >= expiry
+
+    @staticmethod
+    def _jwt_expiry(token):
+        """Return the expiry time (exp claim) of a jwt, or None if it can not be decoded."""
+        try:
+            payload = token.split(".")[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+            return int(claims["exp"])
+        except (IndexError, ValueError, KeyError, TypeError):
+            return None
 
     def load_tokens_from_web(self):
+        metrics.increment("token_logins_total")
+        with metrics.timer("token_login_duration_seconds"):
+            self._login()
+
+    def _login(self):
+        # each step of the login is also timed, by endpoint, as an http request
         logging.info("Retrieving tokens using web api")
 
-        # using a session so that cookies are managed
-        s = requests.Session()
+        # only needed for this (rare) full login, so not imported with the module
+        import secrets
+        from bs4 import BeautifulSoup
+
+        # using a separate session so that cookies are managed
+        s = http_session.create_session()
 
         # fetch the login page
         headers = {
-            "User-Agent": user_agent
+            "User-Agent": config.get("url", "user_agent")
         }
         params = {
             "nonce": secrets.token_urlsafe(12),
             "redirect_uri": "weconnect://authenticated"
         }
         logging.info("Fetching login page")
-        resp = s.get(login_url + "/authorize", headers=headers, params=params)
+        resp = s.get(config.get("url", "login") + "/authorize", headers=headers, params=params)
         resp.raise_for_status()
 
         # submit email identity
@@ -71,7 +130,7 @@ class Tokens:
         data["email"] = config.get("user", "email")
         data["registerFlow"] = False
         logging.info("Submitting email as identity")
-        form_url = identity_url + form.get("action")
+        form_url = config.get("url", "identity") + form.get("action")
         resp = s.post(form_url, data=data)
         resp.raise_for_status()
 
@@ -121,7 +180,7 @@ class Tokens:
 
         # fetch access and refresh tokens
         headers = {
-            "User-Agent": user_agent,
+            "User-Agent": config.get("url", "user_agent"),
             "Content-type": "application/json"
         }
         data = {
@@ -133,26 +192,32 @@ class Tokens:
             "authorizationCode": fragments["code"][0]
         }
         logging.info("Fetching access and refresh tokens")
-        resp = s.post(login_url + "/login/v1", headers=headers, json=data)
+        resp = s.post(config.get("url", "login") + "/login/v1", headers=headers, json=data)
         resp.raise_for_status()
 
         # store access and refresh tokens in a file
-        self.tokens = resp.json()
-        with open(config.get("settings", "token_file"), "w") as f:
-            json.dump(self.tokens, f)
-
-    def refresh_tokens_from_web(self):
+        self._save_tokens(resp.json())
+
+    def refresh_tokens_from_web(self, rejected_access_token=None):
+        """Refresh the tokens, unless the rejected access token has already been replaced."""
+        with self.lock:
+            self._reload_if_changed()
+            if rejected_access_token is not None and self.tokens.get("accessToken") != rejected_access_token:
+                logging.info("Tokens have already been refreshed")
+                return
+            self._refresh_tokens()
+
+    def _refresh_tokens(self):
         logging.info("Refreshing tokens using web api")
+        metrics.increment("token_refreshes_total")
         headers = {
-            "User-Agent": user_agent,
+            "User-Agent": config.get("url", "user_agent"),
             "Content-type": "application/json",
             "Authorization": "Bearer {}".format(self.get_refresh_token())
         }
         logging.info("Fetching new access and new refresh tokens")
-        resp = requests.get(login_url + "/refresh/v1", headers=headers)
+        resp = http_session.get_session().get(config.get("url", "login") + "/refresh/v1", headers=headers)
         resp.raise_for_status()
 
         # store access and refresh tokens in a file
-        self.tokens = resp.json()
-        with open(config.get("settings", "token_file"), "w") as f:
-            json.dump(self.tokens, f)
+        self._save_tokens(resp.json())
@@ -0,0 +1,61 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_pending = {}
+_lock = threading.Lock()
+
+
+def submit(filename, function, *args):
+    """Write the file in the background, after any writes submitted before it, so api calls do not wait on the disk.
+
+    Writes run one at a time, in the order they were submitted.
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="writer")
+        future = _executor.submit(function, *args)
+        _pending.setdefault(filename, []).append(future)
+    return future
+
+
+def wait(filename=None):
+    """Wait for the pending writes of the file (or of every file), raising the error of a write that failed."""
+    with _lock:
+        if filename is None:
+            futures = [future for futures in _pending.values() for future in futures]
+            _pending.clear()
+        else:
+            futures = _pending.pop(filename, [])
+
+    errors = [error for error in (future.exception() for future in futures) if error is not None]
+    for error in errors[1:]:
+        logging.error("Unable to write file: %s", error)
+    if errors:
+        raise errors[0]
+
+
+@contextmanager
+def atomic_open(filename, permissions=0o666):
+    """Open a temporary file that replaces the file once it has been written and closed.
+
+    An interrupted write never leaves a partially written file. The temporary file is named
+    after the process and thread writing it, so writes of the same file at the same time (e.g.
+    by a cron job and the daemon) do not write into each other's temporary file.
+    """
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    tmp_file = "{}.{}.{}.tmp".format(filename, os.getpid(), threading.get_ident())
+    try:
+        with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, permissions), "w") as f:
+            yield f
+        os.replace(tmp_file, filename)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise